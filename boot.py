@@ -1,3 +1,10 @@
+try:
+	# Puts the active code slot on sys.path, so src below resolves to it
+	import slot
+	slot.select()
+except Exception as e:
+	print('Failed to select code slot: ', e)
+
 try:
 	import src.boot
 except Exception as e:
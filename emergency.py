@@ -143,15 +143,22 @@ class GitHub:
   def download(self, sha=None, destination=None, currentDir='', base=''):
     fileList = get('%s/contents/%s?ref=%s' % (self.remote, self.io.path(base, currentDir), sha), logger=self.logger, headers=self.headers)
 
-    for file in fileList.json():
-      if file['type'] == 'file':
-        result = get(file['download_url'], logger=self.logger, headers=self.headers)
-        result.save(self.io.path(destination, currentDir, file['name']))
-      elif file['type'] == 'dir':
-        self.io.mkdir(self.io.path(destination, currentDir, file['name']))
-        self.download(sha=sha, destination=destination, currentDir=self.io.path(currentDir, file['name']), base=base)
-
-    fileList.close()
+    # The listing is parsed while it streams in. Files are downloaded right
+    # away (from another host), directories only once the listing is done.
+    dirs = []
+    try:
+      for file in items(fileList.raw, ('type', 'name', 'download_url')):
+        if file['type'] == 'file':
+          result = get(file['download_url'], logger=self.logger, headers=self.headers)
+          result.save(self.io.path(destination, currentDir, file['name']))
+        elif file['type'] == 'dir':
+          dirs.append(file['name'])
+    finally:
+      fileList.close()
+
+    for name in dirs:
+      self.io.mkdir(self.io.path(destination, currentDir, name))
+      self.download(sha=sha, destination=destination, currentDir=self.io.path(currentDir, name), base=base)
 
 # requests.py
 
@@ -408,13 +415,214 @@ def b64encode(s, altchars=None):
     return encoded
 
 
+# jsonstream.py
+
+_WS = b' \t\r\n'
+_QUOTE = 0x22
+_BACKSLASH = 0x5c
+_COMMA = 0x2c
+_COLON = 0x3a
+_OPEN = b'{['
+_CLOSE = b'}]'
+_ESCAPES = {0x62: 0x08, 0x66: 0x0c, 0x6e: 0x0a, 0x72: 0x0d, 0x74: 0x09}
+_LITERALS = {'true': True, 'false': False, 'null': None}
+
+class Reader:
+  def __init__(self, stream, bufferSize=128):
+    self.stream = stream
+    self.buf = bytearray(bufferSize)
+    self.pos = 0
+    self.end = 0
+
+  def peek(self):
+    if self.pos == self.end:
+      self.end = self.stream.readinto(self.buf) or 0
+      self.pos = 0
+      if not self.end:
+        raise ValueError('Unexpected end of JSON')
+    return self.buf[self.pos]
+
+  def next(self):
+    c = self.peek()
+    self.pos += 1
+    return c
+
+  def ws(self):
+    # Skips whitespace and returns the next byte without consuming it
+    c = self.peek()
+    while c in _WS:
+      self.pos += 1
+      c = self.peek()
+    return c
+
+  def expect(self, c):
+    if self.ws() != c:
+      raise ValueError('Expected %s in JSON, got %s' % (chr(c), chr(self.peek())))
+    self.pos += 1
+
+  def string(self, keep=True):
+    # Reads a string, or only skips over it when keep is False
+    self.expect(_QUOTE)
+    out = bytearray() if keep else None
+    while True:
+      c = self.next()
+      if c == _QUOTE:
+        return out.decode() if keep else None
+      if c == _BACKSLASH:
+        c = self.next()
+        if c == 0x75: # \uXXXX
+          code = 0
+          for i in range(4):
+            code = code * 16 + int(chr(self.next()), 16)
+          if keep:
+            out.extend(chr(code).encode())
+          continue
+        c = _ESCAPES.get(c, c)
+      if keep:
+        out.append(c)
+
+  def literal(self):
+    out = bytearray()
+    c = self.peek()
+    while c not in _WS and c != _COMMA and c not in _CLOSE:
+      out.append(c)
+      self.pos += 1
+      c = self.peek()
+    token = out.decode()
+    if token in _LITERALS:
+      return _LITERALS[token]
+    try:
+      return int(token)
+    except ValueError:
+      return float(token)
+
+  def value(self):
+    c = self.ws()
+    if c == _QUOTE:
+      return self.string()
+    if c == _OPEN[0]:
+      return self.object()
+    if c == _OPEN[1]:
+      return [self.value() for _ in self.array()]
+    return self.literal()
+
+  def skip(self):
+    c = self.ws()
+    if c == _QUOTE:
+      self.string(False)
+    elif c in _OPEN:
+      depth = 0
+      while True:
+        c = self.peek()
+        if c == _QUOTE:
+          self.string(False)
+          continue
+        self.pos += 1
+        if c in _OPEN:
+          depth += 1
+        elif c in _CLOSE:
+          depth -= 1
+          if not depth:
+            return
+    else:
+      self.literal()
+
+  def members(self):
+    # Yields the keys of an object, the caller has to read or skip each value
+    self.expect(_OPEN[0])
+    if self.ws() == _CLOSE[0]:
+      self.pos += 1
+      return
+    while True:
+      key = self.string()
+      self.expect(_COLON)
+      yield key
+      c = self.ws()
+      self.pos += 1
+      if c == _CLOSE[0]:
+        return
+      if c != _COMMA:
+        raise ValueError('Expected , or } in JSON, got %s' % chr(c))
+
+  def object(self, keys=None):
+    # Only values of the given keys are built, everything else is skipped
+    result = {}
+    for key in self.members():
+      if keys is None or key in keys:
+        result[key] = self.value()
+      else:
+        self.skip()
+    return result
+
+  def array(self):
+    # Yields the position of each element, the caller has to read or skip it
+    self.expect(_OPEN[1])
+    if self.ws() == _CLOSE[1]:
+      self.pos += 1
+      return
+    while True:
+      yield
+      c = self.ws()
+      self.pos += 1
+      if c == _CLOSE[1]:
+        return
+      if c != _COMMA:
+        raise ValueError('Expected , or ] in JSON, got %s' % chr(c))
+
+  def find(self, key):
+    # Moves to the value of key in the current object
+    for k in self.members():
+      if k == key:
+        return
+      self.skip()
+    raise KeyError(key)
+
+def items(stream, keys, path=(), bufferSize=128):
+  # Yields a dict with only the given keys for each object in the array at
+  # path (a sequence of object keys, empty for a top-level array)
+  reader = Reader(stream, bufferSize)
+  for key in path:
+    reader.find(key)
+  for _ in reader.array():
+    yield reader.object(keys)
+
 # main.py
 
-import time, os, machine
+import time, os, machine, network, env
 
 led = machine.Pin('LED', machine.Pin.OUT)
 led.off()
 
+# A new code slot that fails to import lands here on its first boot. Go back
+# to the previous slot instead of reinstalling the (broken) latest release.
+try:
+	import slot
+except ImportError:
+	slot = None
+if slot:
+	state = slot.read()
+	if not state['confirmed'] and state['previous'] is not None:
+		slot.rollback(state)
+		time.sleep(5)
+		machine.reset()
+
+# boot.py no longer connects, the emergency update needs the network anyway
+sta_if = network.WLAN(network.STA_IF)
+if not sta_if.isconnected():
+	print('Connecting to network...')
+	sta_if.active(True)
+	sta_if.connect(env.settings['wifiAP'], env.settings['wifiPassword'])
+	count = 0
+	while not sta_if.isconnected():
+		led.toggle()
+		time.sleep(1)
+		count += 1
+		if count >= 45:
+			print('Failed to connect to network')
+			time.sleep(5)
+			machine.reset()
+	led.off()
+
 t = Time(time=time)
 
 # Configure Logger
@@ -434,6 +642,11 @@ updater = OTAUpdater(io=io, github=github, logger=loggerOta, machine=machine)
 
 try:
 	updater.update()
+	# Nothing to roll back to, boot the recovered /src instead of a code slot
+	if slot:
+		state = slot.read()
+		if state['active']:
+			slot.write({'active': '', 'previous': None, 'boots': 0, 'confirmed': True, 'failed': state.get('failed')})
 	time.sleep(30)
 	machine.reset()
 except Exception as e:
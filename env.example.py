@@ -3,16 +3,22 @@ settings = {
   'wifiPassword': 'password',
   'controllerName': 'weatherstation-test', # Used for DHCP hostname
   'logInclude': ['.*'], # regex supported
-  'logExclude': [], # regex supported
+  'logExclude': [], # regex supported, a rejected name (e.g. weatherstation:read) mutes everything below it
+  'logLevel': 'debug', # debug, info, warn or error
+  'logRing': 4096, # bytes of log history kept in RAM and flushed to the log files (at most 65535), 0 to disable
+  'logFile': '', # text log file on flash, e.g. 'log.txt'
+  'logUdp': None, # (host, port) to send log lines to, e.g. ('192.168.1.10', 5140)
   'httpTimeout': 2, # seconds
   'debug': 'True',
   'onlyRunOnce': 'False',
+  'ntpServers': ('pool.ntp.org', 'time.google.com', 'time.cloudflare.com'), # tried in order
 
   # Auto-Updating
   'githubRemote': 'https://github.com/lmg-anrath/weatherstation-pico',
   'githubRemoteBranch': 'main',
   'githubUsername': '', # Optional: Without this, you may hit API limits
   'githubToken': '', # Optional: Without this, you may hit API limits
+  'otaMode': 'delta', # files, archive (one tarball, needs the deflate module) or delta (changed files only)
 
   # Station Settings
   'serverURL': 'https://api.wetterstation-lmg.de',
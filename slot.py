@@ -0,0 +1,71 @@
+# A/B code slots: the app lives in /slot_a/src or /slot_b/src and the pointer
+# file names the active one. Without a pointer the legacy /src is used.
+
+import json, os, sys
+
+POINTER = '.slot'
+SLOTS = ('slot_a', 'slot_b')
+MAX_BOOTS = 3 # unconfirmed boots before rolling back
+
+def read():
+	try:
+		with open(POINTER) as f:
+			return json.load(f)
+	except:
+		return {'active': '', 'previous': None, 'boots': 0, 'confirmed': True}
+
+def write(state):
+	# Rename is atomic on LittleFS, so a power cut leaves the old or the new pointer
+	with open(POINTER + '.tmp', 'w') as f:
+		json.dump(state, f)
+	os.rename(POINTER + '.tmp', POINTER)
+
+def other(active):
+	return SLOTS[1] if active == SLOTS[0] else SLOTS[0]
+
+def select():
+	# Runs once per boot, before anything is imported from src
+	state = read()
+	if not state['confirmed']:
+		state['boots'] += 1
+		if state['boots'] > MAX_BOOTS and state['previous'] is not None:
+			print('[Slot] %s failed to boot %d times' % (state['active'], MAX_BOOTS))
+			state = rollback(state)
+		else:
+			write(state)
+
+	if state['active']:
+		sys.path.insert(0, '/' + state['active'])
+	return state
+
+def rollback(state):
+	# Goes back to the previous slot for good, also used by emergency.py when
+	# a new slot fails to import at all
+	print('[Slot] Rolling back from %s to %s' % (state['active'], state['previous'] or 'src'))
+	# Remember the broken version so the updater doesn't install it again
+	try:
+		with open(state['active'] + '/src/.version') as f:
+			failed = f.read()
+	except:
+		failed = None
+	state = {'active': state['previous'], 'previous': None, 'boots': 0, 'confirmed': True, 'failed': failed}
+	write(state)
+	return state
+
+def switch(target):
+	# Boots into target from now on, keeping the current slot for rollback
+	state = read()
+	write({'active': target, 'previous': state['active'], 'boots': 0, 'confirmed': False, 'failed': state.get('failed')})
+
+def confirm():
+	state = read()
+	if not state['confirmed']:
+		state['boots'] = 0
+		state['confirmed'] = True
+		write(state)
+
+def release():
+	# Forgets the previous slot once it has been deleted
+	state = read()
+	state['previous'] = None
+	write(state)
@@ -1,14 +1,20 @@
-import json, machine, urequests, json, gc, asyncio
+import json, machine, json, gc, asyncio
 from machine import Pin
 import src.app.lib.sds011 as lib_sds011, src.app.lib.bmp280 as lib_bmp280, dht as lib_dht22
 
+INTERVAL = 15 * 60 # seconds between measurements
+STAGING_MARGIN = 60 # seconds kept free between staging an update and waking up the sensors
+
 class Main:
-	def __init__(self, env, requests, logger, time, updater):
+	def __init__(self, env, requests, logger, time, updater, clock=None, radio=None):
 		# Setting global variables
 		self.env = env
 		self.requests = requests
 		self.time = time
 		self.updater = updater
+		self.clock = clock
+		# Without a radio the network is assumed to be up all the time
+		self.radio = radio
 
 		# Setting up logger
 		self.log = logger(append='weatherstation')
@@ -37,7 +43,7 @@ class Main:
 			self.sds011.sleep()
 			log('SDS011 setup complete.')
 		except Exception as e:
-			log('Failed to setup SDS011:', e)
+			log.error('Failed to setup SDS011: %s', e)
 			self.sds011 = None
 
 		# Setup of BMP280 sensor (temperature and pressure sensor)
@@ -59,7 +65,7 @@ class Main:
 			self.bmp280.sleep()
 			log('BMP280 setup complete.')
 		except Exception as e:
-			log('Failed to setup BMP280:', e)
+			log.error('Failed to setup BMP280: %s', e)
 			self.bmp280 = None
 
 		# Setup of DHT22 sensor (humidity and temperature sensor)
@@ -69,7 +75,7 @@ class Main:
 			self.dht22 = lib_dht22.DHT22(Pin(15, Pin.IN, Pin.PULL_UP))
 			log('DHT22 setup complete.')
 		except Exception as e:
-			log('Failed to setup DHT22:', e)
+			log.error('Failed to setup DHT22: %s', e)
 			self.dht22 = None
 
 		self.time.sleep(5)
@@ -82,155 +88,225 @@ class Main:
 		log('Starting main loop...')
 		loop = self.env.settings['onlyRunOnce'] != 'True'
 		runs = 0
+		# Monotonic time of the next measurement, on the 15 minute grid
+		nextRun = self.time.now() // INTERVAL * INTERVAL + INTERVAL
 
 		if not loop:
-			log('[WARN] The program will only run once due to onlyRunOnce being set to True.')
+			log.warn('The program will only run once due to onlyRunOnce being set to True.')
 
 		while True:
 			if loop:
-				# Wait for the next 15 minute interval
-				(year, month, day, hour, minute, second, wday, yday) = self.time.localtime()
-				wait_time = ((minute // 15 + 1) * 15 - minute) * 60 - second
-				log('Waiting %s seconds...' %wait_time)
+				# Wait for the next 15 minute interval, on the monotonic clock so NTP corrections can't skew it
+				now = self.time.now()
+				if now >= nextRun + INTERVAL:
+					# Overran by more than an interval, skip the missed ones
+					nextRun += (now - nextRun) // INTERVAL * INTERVAL
+				wait_time = max(0, nextRun - now)
+				nextRun += INTERVAL
+				log.info('Waiting %d seconds...', wait_time)
 				self.led.off()
 
+				# Persist the log history before idling
+				self.log.flush()
+
 				# Wait until 30 seconds before the next 15 minute interval to wake up sensors
 				if wait_time > 30:
 					self.time.sleep(wait_time - 30)
 				else:
 					self.time.sleep(wait_time)
 
-			log('Waking up sensors...')
+			log.debug('Waking up sensors...')
 			self.led.on()
 			try:
 				self.sds011.wake()
 			except Exception as e:
-				log('Failed to wake up SDS011: ', e)
+				log.error('Failed to wake up SDS011: %s', e)
 			try:
 				self.bmp280.force_measure()
 			except Exception as e:
-				log('Failed to wake up BMP280: ', e)
-
-			if loop:
-				self.time.sleep(30)
-			else:
-				self.time.sleep(10)
-
-			#blink = asyncio.create_task(blink(self.led, 0.5))
-
-			# Reading sensor data
-			data = self.read()
-
-			# Upload data to server
-			self.upload(data)
-
-			#blink.cancel()
-			self.led.on()
+				log.error('Failed to wake up BMP280: %s', e)
 
-			# Sleeping sensors
-			log('Sleeping sensors...')
-			try:
-				self.sds011.sleep()
-			except Exception as e:
-				log('Failed to sleep SDS011: ', e)
-			try:
-				self.bmp280.sleep()
-			except Exception as e:
-				log('Failed to sleep BMP280: ', e)
+			# Warm-up, reading and upload, the network comes up during the warm-up
+			asyncio.run(self.cycle(log, 30 if loop else 10, loop))
+			if self.radio is not None:
+				log.info('Radio was on for %d ms', self.radio.cycle())
 
 			# Collecting garbage
 			gc.collect()
 
 			runs += 1
-			log('Run %s complete' % runs)
+			log.info('Run %s complete, %s log records dropped so far', runs, self.log.dropped())
 
 			# Rebooting every 6 hours
 			if runs >= 24: # 24 runs / 15 minutes = 6 hours
-				log('Ran 24 times, rebooting...')
+				log.warn('Ran 24 times, rebooting...')
+				self.log.flush()
 				machine.reset()
 				break
 
-			# Checking for updates
-			if self.updater is not None:
-				self.updater.checkForUpdate()
-
 			# Break loop if onlyRunOnce is set to True
 			if not loop:
 				self.led.off()
 				log('Exiting...')
+				self.log.flush()
 				break
 
+	async def cycle(self, log, warmup, loop):
+		# The sensors warm up while the previous version is removed and the
+		# radio connects, so the upload follows the reading right away
+		deadline = self.time.ticks_add(self.time.ticks_ms(), warmup * 1000)
+
+		# Drop the previous version before anything is staged into its slot
+		if self.updater is not None:
+			self.updater.collect()
+
+		online = self.radio is None or self.radio.up()
+		try:
+			await asyncio.sleep(max(0, self.time.ticks_diff(deadline, self.time.ticks_ms())) / 1000)
+
+			# Reading sensor data
+			data = self.read()
+
+			# Sleeping sensors, before the upload so they don't run through it
+			log.debug('Sleeping sensors...')
+			try:
+				self.sds011.sleep()
+			except Exception as e:
+				log.error('Failed to sleep SDS011: %s', e)
+			try:
+				self.bmp280.sleep()
+			except Exception as e:
+				log.error('Failed to sleep BMP280: %s', e)
+
+			# A completed measurement confirms this version, whether or not the network works
+			if self.updater is not None:
+				self.updater.confirm()
+
+			if not online:
+				log.error('No network, measurement not uploaded: %s', self.radio.wifi.timings)
+				return
+			await self.upload(data)
+			self.led.on()
+			self.online(log, loop)
+		finally:
+			# The radio is only on for this window
+			if online and self.radio is not None:
+				self.radio.down()
+
+	def online(self, log, loop):
+		# Everything after the upload that needs the network, called while the radio is up
+		# Reboot into a staged version right after the upload, so no interval is missed
+		if self.updater is not None and self.updater.staged:
+			log.warn('Switching to the staged update...')
+			self.updater.activate()
+			self.log.flush()
+			machine.reset()
+
+		# Retry a failed boot sync, or resync after the interval, while the radio is on anyway
+		if self.clock is not None and self.clock.stale():
+			try:
+				if self.clock.sync():
+					self.time.sync()
+					log.info('Synced the clock, ticks drift %s', self.time.drift)
+			except Exception as e:
+				log.error('Failed to sync the clock: %s', e)
+
+		if self.updater is None:
+			return
+		if not loop:
+			# Nothing runs after this one, the download can take as long as it needs
+			if self.updater.update():
+				log.warn('Update installed, rebooting...')
+				self.log.flush()
+				machine.reset()
+			return
+
+		# Download the next version in the idle time, leaving a margin before the sensors wake up
+		budget = self.time.until(INTERVAL) - 30 - STAGING_MARGIN
+		if budget > 0:
+			try:
+				self.updater.stage(budget=budget)
+			except Exception as e:
+				log.error('Failed to stage update: %s', e)
+
 	def read(self):
 		read_log = self.log(append='read')
-		read_log('Reading sensor data...')
+		read_log.debug('Reading sensor data...')
 		data = {
 			'timestamp': str(round(self.time.time())),
 		}
     
 		if self.sds011 is not None:
 			log = read_log(append='sds011')
-			log('-- SDS011 Sensor --')
+			log.debug('-- SDS011 Sensor --')
 			# Returns NOK if no measurement found in reasonable time
-			log('Reading data...')
+			log.debug('Reading data...')
 			status = self.sds011.read()
 			# Returns NOK if checksum failed
 			pkt_status = self.sds011.packet_status
 			# Stop fan
-			log('Data read, sleep sensor...')
+			log.debug('Data read, sleep sensor...')
 			self.sds011.sleep()
 
 			if status == False:
-				log('Measurement failed.')
+				log.warn('Measurement failed.')
 			elif pkt_status == False:
-				log('Received corrupted data.')
+				log.warn('Received corrupted data.')
 			else:
 				data['air_particle_pm25'] = self.sds011.pm25
 				data['air_particle_pm10'] = self.sds011.pm10
-				log('PM2.5: %s' % data['air_particle_pm25'])
-				log('PM10: %s' % data['air_particle_pm10'])
+				log.info('PM2.5: %s', data['air_particle_pm25'])
+				log.info('PM10: %s', data['air_particle_pm10'])
 
 		if self.bmp280 is not None:
 			log = read_log(append='bmp280')
-			log('-- BMP280 Sensor --')
-			log('Reading data...')
+			log.debug('-- BMP280 Sensor --')
+			log.debug('Reading data...')
 			data['temperature'] = self.bmp280.temperature
 			data['air_pressure'] = self.bmp280.pressure / 100
 
-			log('Data read, sleep sensor...')
+			log.debug('Data read, sleep sensor...')
 			self.bmp280.sleep()
 
-			log('Temperature: %s C' % data['temperature'])
-			log('Pressure: %s hPa' % data['air_pressure'])
+			log.info('Temperature: %s C', data['temperature'])
+			log.info('Pressure: %s hPa', data['air_pressure'])
 
 		if self.dht22 is not None:
 			log = read_log(append='dht22')
-			log('-- DHT22 Sensor --')
+			log.debug('-- DHT22 Sensor --')
 			self.dht22.measure()
 			try:
 				data['humidity'] = self.dht22.humidity()
 				data['temperature'] = self.dht22.temperature()
-				log('Temperature: %s C' % data['temperature'])
-				log('Humidity: %s %%' % data['humidity'])
+				log.info('Temperature: %s C', data['temperature'])
+				log.info('Humidity: %s %%', data['humidity'])
 			except Exception as e:
-				log('Measurement failed.', e)
+				log.warn('Measurement failed. %s', e)
 
-		read_log('Finished reading sensor data.')
+		read_log.debug('Finished reading sensor data.')
 		return data
 
-	def upload(self, data):
+	async def upload(self, data):
 		log = self.log(append='upload')
-		log('Uploading data...')
-		log('Data:', data)
+		log.debug('Uploading data...')
+		log.debug('Data: %s', data)
 
 		headers = {
 			'Content-Type': 'application/json',
             'Authorization': self.env.settings['accessToken']
         }
 
-		res = urequests.post(self.env.settings['serverURL'] + '/v2/stations/' + str(self.env.settings['stationId']), data = json.dumps(data), headers = headers)
-		log('Upload completed with status code %s!' %res.status_code)
-		log('Response from server: ' + res.text)
-		res.close()
+		# The LED keeps blinking and the log sinks catch up while the request is in flight
+		led = asyncio.create_task(blink(self.led, 0.5))
+		drain = asyncio.create_task(self.log.run())
+		try:
+			res = await self.requests.apost(self.env.settings['serverURL'] + '/v2/stations/' + str(self.env.settings['stationId']), data = json.dumps(data), headers = headers)
+			log.info('Upload completed with status code %s!', res.status_code)
+			log.debug('Response from server: %s', await res.text)
+			res.close()
+		finally:
+			led.cancel()
+			drain.cancel()
 
 async def blink(led, delay):
 	while True:
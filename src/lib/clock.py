@@ -0,0 +1,39 @@
+# Sets the RTC from NTP. The servers are tried in order with a short timeout
+# each, so one that doesn't answer can't hold up the boot for long. rp2 resets
+# the RTC on every hard reset, so every boot syncs; a failed sync is retried in
+# every network window of the loop, a good one is repeated every interval.
+
+SERVERS = ('pool.ntp.org', 'time.google.com', 'time.cloudflare.com')
+
+class Clock:
+  def __init__(self, ntptime=None, machine=None, time=None, logger=None, servers=SERVERS, timeout=1, interval=6 * 3600):
+    self.ntptime = ntptime
+    self.machine = machine
+    self.time = time
+    self.log = logger(append='clock')
+    self.servers = servers
+    # Per server, so a sync takes at most len(servers) * timeout seconds
+    self.timeout = timeout
+    # Time between syncs once running
+    self.interval = interval
+    # RTC time of the last sync, None until one worked
+    self.synced = None
+
+  def stale(self):
+    return self.synced is None or not 0 <= self.time.time() - self.synced < self.interval
+
+  def sync(self):
+    # Sets the RTC from the first NTP server that answers, returns True on success
+    self.ntptime.timeout = self.timeout
+    for server in self.servers:
+      self.ntptime.host = server
+      try:
+        now = self.ntptime.time()
+      except Exception as e:
+        self.log.warn('NTP server %s failed: %s', server, e)
+        continue
+      tm = self.time.gmtime(now)
+      self.machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+      self.synced = now
+      return True
+    return False
@@ -1,54 +1,369 @@
 import re
 import io
+import os
+import struct
 
-def config(time=None, enabled=False, include=None, exclude=None):
-  logger = Logger(time=time, enabled=enabled, include=include, exclude=exclude)
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warn': WARN, 'error': ERROR}
+_TAGS = {DEBUG: '', INFO: '', WARN: 'WARN ', ERROR: 'ERROR '}
 
-  def log(*args, append=None, existing='', name=''):
+def config(time=None, enabled=False, include=None, exclude=None, level='debug', ring=None, sinks=None):
+  logger = Logger(time=time, enabled=enabled, include=include, exclude=exclude, level=level, ring=ring, sinks=sinks)
+  return logger.append('')
+
+def _noop(*args, **kwargs):
+  pass
+
+class Null:
+  # Stands in for every channel of a disabled logger, so log statements cost a
+  # single call and appending never creates anything
+  def __call__(self, *args, append=None, name=''):
+    return self if append else None
+
+  def append(self, name):
+    return self
+
+  debug = info = warn = error = flush = staticmethod(_noop)
+
+  def dropped(self):
+    return 0
+
+  async def run(self, interval=0.1):
+    pass
+
+NULL = Null()
+
+class Channel:
+  # A named logger. The full name is built once when appending and levels
+  # below the threshold are bound to a no-op, calls only pay for what is emitted.
+  def __init__(self, logger, name):
+    self.logger = logger
+    self.name = name
+    for (level, method) in ((DEBUG, 'debug'), (INFO, 'info'), (WARN, 'warn'), (ERROR, 'error')):
+      if level < logger.level:
+        setattr(self, method, _noop)
+
+  def __call__(self, *args, append=None, name=''):
+    # log('text', value) joins its arguments like print, log(append='x') appends
     if append:
-      existing = existing + ':' + append
-      return lambda *args, append=None, name='': log(*args, name=name, append=append, existing=existing)
-    
-    name = (existing + ':' + name).lstrip(':').rstrip(':')
-    return logger(*args, name=name)
-    
-  return log
+      return self.append(append)
+    return self.logger(*args, name=self._name(name))
+
+  def append(self, name):
+    return self.logger.append(self._name(name))
+
+  def flush(self):
+    self.logger.flush()
+
+  def dropped(self):
+    return self.logger.dropped()
+
+  def run(self, interval=0.1):
+    return self.logger.run(interval)
+
+  def _name(self, name):
+    if not name:
+      return self.name
+    return (self.name + ':' + name) if self.name else name
+
+  # Formatting is deferred: log.info('Read %s', value) only builds the text when emitted
+  def debug(self, fmt, *args, name=''):
+    self.logger.emit(DEBUG, self._name(name), fmt, args)
+
+  def info(self, fmt, *args, name=''):
+    self.logger.emit(INFO, self._name(name), fmt, args)
+
+  def warn(self, fmt, *args, name=''):
+    self.logger.emit(WARN, self._name(name), fmt, args)
+
+  def error(self, fmt, *args, name=''):
+    self.logger.emit(ERROR, self._name(name), fmt, args)
 
 class Logger:
-  def __init__(self, time=None, enabled=False, include=None, exclude=None):
-    self.print = print
+  def __init__(self, time=None, enabled=False, include=None, exclude=None, level='debug', cacheSize=32, ring=None, sinks=None):
     self.time = time
+    # Where records go, the console (plus ring) unless given
+    if sinks is None:
+      sinks = [Console(time)] + ([ring] if ring else [])
+    self.sinks = sinks
     self.enabled = enabled
-    self.include = list(map(re.compile, include))
-    self.exclude = list(map(re.compile, exclude))
+    self.level = LEVELS[level] if isinstance(level, str) else level
+    self.cacheSize = cacheSize
+    self.filter(include, exclude)
 
-  def __call__(self, *args, name=''):
-    if not self.enabled:
-      return
+  def append(self, name):
+    # An excluded channel is as free as a disabled logger, and so is
+    # everything appended below it. Includes are matched against the full
+    # name when a record is emitted, a deeper name may still match.
+    if not self.enabled or (name and self.excluded(name)):
+      return NULL
+    return Channel(self, name)
 
-    included = False
-    excluded = False
-    for include in self.include:
-      if include.search(name):
-        included = True
-    for exclude in self.exclude:
-      if exclude.search(name):
-        excluded = True
+  def excluded(self, name):
+    return any(exclude.search(name) for exclude in self.exclude)
 
-    if not included and not excluded:
-      return
-    elif not included and excluded:
+  def filter(self, include=None, exclude=None):
+    # Replaces the name filters, decisions made with the old ones are dropped.
+    # Channels already appended and muted by an exclude stay muted, they are
+    # the shared NULL. Only channels appended afterwards see the new excludes.
+    self.include = list(map(re.compile, include or []))
+    self.exclude = list(map(re.compile, exclude or []))
+    # The default configuration lets every name through without matching
+    self.everything = list(include or []) == ['.*'] and not exclude
+    self.decisions = {}
+
+  def allowed(self, name):
+    # A name always gets the same answer, so each is matched only once
+    if self.everything:
+      return True
+    decision = self.decisions.get(name)
+    if decision is None:
+      decision = any(include.search(name) for include in self.include) and not self.excluded(name)
+      if len(self.decisions) >= self.cacheSize:
+        self.decisions.clear()
+      self.decisions[name] = decision
+    return decision
+
+  def emit(self, level, name, fmt, args):
+    if not self.enabled or level < self.level or not self.allowed(name):
       return
-    elif included and not excluded:
-      pass
-    elif included and excluded:
+    return self.write(name, _TAGS[level] + (fmt % args if args else '%s' % fmt))
+
+  def write(self, name, message):
+    record = (int(self.time.time()), name, message)
+    for sink in self.sinks:
+      sink.put(record)
+    return message
+
+  def flush(self):
+    # Call before sleeping or resetting: writes everything queued, even if
+    # that blocks, and persists the ring
+    for sink in self.sinks:
+      sink.flush()
+
+  def dropped(self):
+    return sum(sink.dropped for sink in self.sinks)
+
+  async def run(self, interval=0.1):
+    # Drains the sink queues while an asyncio loop is running
+    import asyncio
+    while True:
+      for sink in self.sinks:
+        sink.drain()
+      await asyncio.sleep(interval)
+
+  def __call__(self, *args, name=''):
+    if not self.enabled or INFO < self.level or not self.allowed(name):
       return
 
     statement = []
     for arg in args:
       statement.append('%s' % arg)
-    
-    statement = "[%s][%s] %s" % (self.time.dateTimeIso(), name, ' '.join(statement))
-    self.print(statement)
-    return statement
 
+    return self.write(name, ' '.join(statement))
+
+class Sink:
+  # Outputs records without blocking the caller. A record is written right
+  # away when the output is ready, otherwise queued (up to size, further
+  # records are counted in dropped) until drain() or flush() catches up.
+  def __init__(self, size=16):
+    self.queue = []
+    self.size = size
+    self.dropped = 0
+
+  def ready(self):
+    return False
+
+  def put(self, record):
+    if not self.queue and self.ready():
+      self.emit(record)
+    elif len(self.queue) < self.size:
+      self.queue.append(record)
+    else:
+      self.dropped += 1
+
+  def drain(self):
+    while self.queue and self.ready():
+      self.emit(self.queue.pop(0))
+
+  def flush(self):
+    while self.queue:
+      self.emit(self.queue.pop(0))
+
+  def emit(self, record):
+    raise NotImplementedError
+
+  def format(self, record):
+    return "[%s][%s] %s" % (self.time.dateTimeIso(record[0]), record[1], record[2])
+
+class Console(Sink):
+  # print(), skipped while the USB serial host isn't reading
+  def __init__(self, time, size=16, print=print):
+    super().__init__(size)
+    self.time = time
+    self.print = print
+    try:
+      import select, sys
+      self.poll = select.poll()
+      self.poll.register(sys.stdout, select.POLLOUT)
+    except Exception:
+      self.poll = None
+
+  def ready(self):
+    return self.poll is None or bool(self.poll.poll(0))
+
+  def emit(self, record):
+    self.print(self.format(record))
+
+class File(Sink):
+  # Text lines appended to a rotating file, a whole queue per write
+  def __init__(self, time, path='log.txt', size=32, files=2, fileSize=16384):
+    super().__init__(size)
+    self.time = time
+    self.path = path
+    self.files = files
+    self.fileSize = fileSize
+
+  def drain(self):
+    # Only called from the asyncio task, where a flash write is acceptable
+    self.flush()
+
+  def flush(self):
+    if not self.queue:
+      return
+    _rotate(self.path, self.files, self.fileSize)
+    with open(self.path, 'a') as file:
+      while self.queue:
+        file.write(self.format(self.queue.pop(0)) + '\n')
+
+class UDP(Sink):
+  # Datagrams to a log collector, by default one on the same host for testing
+  # with the unix port (e.g. nc -ul 5140)
+  def __init__(self, time, host='127.0.0.1', port=5140, size=16):
+    import socket
+    super().__init__(size)
+    self.time = time
+    self.address = socket.getaddrinfo(host, port)[0][-1]
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.socket.setblocking(False)
+
+  def ready(self):
+    return True
+
+  def emit(self, record):
+    try:
+      self.socket.sendto(self.format(record).encode(), self.address)
+    except OSError:
+      # Send buffer full or no network
+      self.dropped += 1
+
+def _rotate(path, files, fileSize):
+  # path -> path.1 -> path.2 ..., the oldest file is deleted
+  try:
+    if os.stat(path)[6] < fileSize:
+      return
+  except OSError:
+    return
+  for i in range(files - 1, 0, -1):
+    older = '%s.%d' % (path, i)
+    try:
+      if i == files - 1:
+        os.remove(older)
+      else:
+        os.rename(older, '%s.%d' % (path, i + 1))
+    except OSError:
+      pass
+  os.rename(path, path + '.1')
+
+# Records are "<time: u32><name id: u8><length: u8>" and up to 255 bytes of
+# message. A batch on flash is MAGIC, the epoch year, records dropped since
+# the last batch, the name table ("<id: u8><length: u8>" + name) and the
+# records. tools/logdecode.py reads the files.
+MAGIC = b'LOGB'
+_RECORD = '<IBB'
+_BATCH = '<4sHHBH'
+
+class Ring(Sink):
+  # Preallocated buffer of compact records, the oldest are overwritten when
+  # full. flush() appends everything as one batch to a rotating file.
+  def __init__(self, size=4096, path='log', files=3, fileSize=16384, epoch=2000):
+    # Writing to RAM never blocks, so the queue stays unused
+    super().__init__(0)
+    # The batch header counts the record bytes in 16 bits
+    self.buf = bytearray(min(size, 0xffff))
+    self.mv = memoryview(self.buf)
+    self.head = 0 # next write position
+    self.used = 0
+    self.lost = 0 # since the last batch
+    self.names = {}
+    self.header = bytearray(struct.calcsize(_RECORD))
+    self.path = path
+    self.files = files
+    self.fileSize = fileSize
+    self.epoch = epoch
+
+  def _copy(self, pos, data):
+    # Copies data into the buffer at pos, wrapping around the end
+    n = len(self.buf) - pos
+    if len(data) <= n:
+      self.mv[pos:pos + len(data)] = data
+    else:
+      self.mv[pos:] = data[:n]
+      self.mv[:len(data) - n] = data[n:]
+    return (pos + len(data)) % len(self.buf)
+
+  def _length(self, pos):
+    # Size of the record at pos, its length byte may have wrapped around
+    return len(self.header) + self.buf[(pos + len(self.header) - 1) % len(self.buf)]
+
+  def ready(self):
+    return True
+
+  def emit(self, record):
+    self.write(*record)
+
+  def write(self, time, name, message):
+    id = self.names.get(name)
+    if id is None:
+      id = len(self.names) if len(self.names) < 255 else 255
+      if id < 255:
+        self.names[name] = id
+    message = message.encode()[:255]
+    size = len(self.header) + len(message)
+    if size > len(self.buf):
+      return
+    # Drop the oldest records until the new one fits
+    while len(self.buf) - self.used < size:
+      self.used -= self._length((self.head - self.used) % len(self.buf))
+      self.lost += 1
+      self.dropped += 1
+    struct.pack_into(_RECORD, self.header, 0, time & 0xffffffff, id, len(message))
+    pos = self._copy(self.head, self.header)
+    self.head = self._copy(pos, message)
+    self.used += size
+
+  def flush(self):
+    if not self.used:
+      return
+    names = bytearray()
+    for (name, id) in self.names.items():
+      encoded = name.encode()[:255]
+      names.append(id)
+      names.append(len(encoded))
+      names.extend(encoded)
+    tail = (self.head - self.used) % len(self.buf)
+    _rotate(self.path, self.files, self.fileSize)
+    with open(self.path, 'ab') as file:
+      file.write(struct.pack(_BATCH, MAGIC, self.epoch, min(self.lost, 0xffff), len(self.names), self.used))
+      file.write(names)
+      # At most two writes for the records, however they wrapped
+      if tail + self.used <= len(self.buf):
+        file.write(self.mv[tail:tail + self.used])
+      else:
+        file.write(self.mv[tail:])
+        file.write(self.mv[:self.head])
+    self.used = 0
+    self.lost = 0
@@ -0,0 +1,113 @@
+# Streaming patcher for binary patches made by tools/patch.py. A patch is
+# "OTAP" + version + old size + new size, followed by operations:
+#   COPY offset length         old[offset:offset + length]
+#   DIFF offset length bytes   old[offset:offset + length] + bytes (per byte)
+#   INSERT length bytes        bytes
+#   END
+# Numbers are unsigned LEB128 varints. The old file is read with seeks, the
+# patch and the new file strictly in order, through one caller owned buffer.
+
+MAGIC = b'OTAP'
+VERSION = 1
+
+END = 0
+COPY = 1
+DIFF = 2
+INSERT = 3
+
+class Reader:
+  def __init__(self, stream, bufferSize=64):
+    self.stream = stream
+    self.buf = bytearray(bufferSize)
+    self.pos = 0
+    self.end = 0
+
+  def byte(self):
+    if self.pos == self.end:
+      self.end = self.stream.readinto(self.buf) or 0
+      self.pos = 0
+      if not self.end:
+        raise ValueError('Unexpected end of patch')
+    self.pos += 1
+    return self.buf[self.pos - 1]
+
+  def varint(self):
+    n = 0
+    shift = 0
+    while True:
+      b = self.byte()
+      n |= (b & 0x7f) << shift
+      if b < 0x80:
+        return n
+      shift += 7
+
+  def readinto(self, mv):
+    # Buffered bytes first, then straight from the stream
+    n = self.end - self.pos
+    if n:
+      n = n if n < len(mv) else len(mv)
+      mv[:n] = self.buf[self.pos:self.pos + n]
+      self.pos += n
+      return n
+    n = self.stream.readinto(mv)
+    if not n:
+      raise ValueError('Unexpected end of patch')
+    return n
+
+def _fill(read, mv):
+  pos = 0
+  while pos < len(mv):
+    n = read(mv[pos:])
+    if not n:
+      raise ValueError('Old file is shorter than the patch expects')
+    pos += n
+
+def apply(old, patch, out, buf, hash=None):
+  # Writes the new file to out and returns its size, hash is updated with
+  # every written chunk. buf is split in two for DIFF operations.
+  reader = Reader(patch)
+  for c in MAGIC:
+    if reader.byte() != c:
+      raise ValueError('Not a patch')
+  version = reader.byte()
+  if version != VERSION:
+    raise ValueError('Unsupported patch version %d' % version)
+  oldSize = reader.varint()
+  newSize = reader.varint()
+  if old.seek(0, 2) != oldSize:
+    raise ValueError('Patch is for another file')
+
+  mv = memoryview(buf)
+  half = len(buf) // 2
+  (a, b) = (mv[:half], mv[half:half * 2])
+  written = 0
+  while True:
+    op = reader.byte()
+    if op == END:
+      break
+    if op == COPY or op == DIFF:
+      old.seek(reader.varint())
+    elif op != INSERT:
+      raise ValueError('Unknown patch operation %d' % op)
+    length = reader.varint()
+    while length:
+      if op == COPY:
+        chunk = mv[:length] if length < len(mv) else mv
+        _fill(old.readinto, chunk)
+      elif op == DIFF:
+        chunk = a[:length] if length < half else a
+        _fill(old.readinto, chunk)
+        _fill(reader.readinto, b[:len(chunk)])
+        for i in range(len(chunk)):
+          chunk[i] = (chunk[i] + b[i]) & 0xff
+      else:
+        chunk = mv[:reader.readinto(mv[:length] if length < len(mv) else mv)]
+      out.write(chunk)
+      if hash:
+        hash.update(chunk)
+      length -= len(chunk)
+      written += len(chunk)
+
+  if written != newSize:
+    raise ValueError('Patch wrote %d of %d bytes' % (written, newSize))
+  return written
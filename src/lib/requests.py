@@ -1,23 +1,167 @@
+import io
 
-class Response:
-  def __init__(self, f):
+try:
+  import deflate
+except ImportError:
+  deflate = None
+
+
+class _Body(io.IOBase):
+  # Stream over the still encoded body for deflate.DeflateIO
+  def __init__(self, resp):
+    self.resp = resp
+
+  def readinto(self, buf):
+    return self.resp._rawinto(buf)
+
+
+class Response(io.IOBase):
+  # A stream itself, so it can be wrapped by e.g. deflate.DeflateIO
+  def __init__(self, f, session=None, key=None):
     self.raw = f
     self.encoding = "utf-8"
+    self.headers = {}
     self._cached = None
+    # Bytes left in the body, None means "until the server closes"
+    self._remaining = None
+    self._chunked = False
+    self._chunkLeft = 0
+    self._crlf = False
+    # deflate.DeflateIO for gzip/deflate Content-Encoding
+    self._decoder = None
+    self._session = session
+    self._key = key
+    self._keepAlive = False
 
   def close(self):
+    self._release()
+    self._cached = None
+
+  def _release(self):
+    # Hand a fully read keep-alive connection back to the session's pool
     if self.raw:
-      self.raw.close()
+      if self._session and self._keepAlive and self._remaining == 0:
+        self._session._put(self._key, self.raw)
+      else:
+        self.raw.close()
       self.raw = None
-    self._cached = None
 
-  def save(self, file):
-    CHUNK_SIZE = 512 # bytes
-    with open(file, 'w') as outfile:
-      data = self.raw.read(CHUNK_SIZE)
-      while data:
+  def _chunk(self, l):
+    # Starts the chunk announced by a chunk-size line, returning False once
+    # the terminating zero-size chunk (or the end of the stream) is reached
+    self._crlf = True
+    if l:
+      self._chunkLeft = int(l.split(b";", 1)[0].strip(), 16)
+      if self._chunkLeft:
+        return True
+    else:
+      self._keepAlive = False
+    self._remaining = 0
+    return False
+
+  def _nextChunk(self):
+    if self._crlf:
+      self.raw.readline() # CRLF after the previous chunk's data
+    if not self._chunk(self.raw.readline()):
+      # Skip trailers up to the final empty line
+      while True:
+        l = self.raw.readline()
+        if not l or l == b"\r\n":
+          break
+
+  def _left(self, n):
+    # How many body bytes may be read next without crossing the framing
+    if not self.raw or self._remaining == 0:
+      return 0
+    if self._chunked:
+      left = self._chunkLeft
+    elif self._remaining is None:
+      return n
+    else:
+      left = self._remaining
+    return left if n < 0 or n > left else n
+
+  def _limit(self, n):
+    if self._chunked and self._chunkLeft == 0 and self._remaining != 0 and self.raw:
+      self._nextChunk()
+    return self._left(n)
+
+  def _advance(self, n):
+    if not n:
+      # Server closed the connection, either to end an unframed body or
+      # before the announced length was received
+      self._keepAlive = False
+      self._remaining = 0
+    elif self._chunked:
+      self._chunkLeft -= n
+    elif self._remaining is not None:
+      self._remaining -= n
+
+  def _rawread(self, n=-1):
+    n = self._limit(n)
+    if n == 0:
+      return b''
+    data = self.raw.read() if n < 0 else self.raw.read(n)
+    self._advance(len(data))
+    return data
+
+  def _rawinto(self, buf):
+    n = self._limit(len(buf))
+    if n == 0:
+      return 0
+    n = self.raw.readinto(buf if n == len(buf) else memoryview(buf)[:n]) or 0
+    self._advance(n)
+    return n
+
+  def _drain(self):
+    # The decoder may stop before the end of the body (e.g. the gzip
+    # trailer), consume the rest so the connection can be reused
+    if self._keepAlive and self._remaining != 0:
+      buf = bytearray(16)
+      while self._rawinto(buf):
+        pass
+
+  def _read(self, n=-1):
+    if not self._decoder:
+      return self._rawread(n)
+    if not self.raw:
+      return b''
+    data = self._decoder.read() if n < 0 else self._decoder.read(n)
+    if not data:
+      self._drain()
+    return data
+
+  def readinto(self, buf):
+    if not self._decoder:
+      return self._rawinto(buf)
+    if not self.raw:
+      return 0
+    n = self._decoder.readinto(buf)
+    if not n:
+      self._drain()
+    return n
+
+  def iter_content(self, buf=512):
+    # Yields views into a single buffer, each one is only valid until the
+    # next iteration. Pass a bytearray to share it between responses.
+    if isinstance(buf, int):
+      buf = bytearray(buf)
+    mv = memoryview(buf)
+    try:
+      n = self.readinto(mv)
+      while n:
+        yield mv[:n]
+        n = self.readinto(mv)
+    finally:
+      self._release()
+
+  def save(self, file, buf=512, hash=None, append=False):
+    # hash (e.g. a hashlib object) is updated with every chunk written
+    with open(file, 'ab' if append else 'wb') as outfile:
+      for data in self.iter_content(buf):
         outfile.write(data)
-        data = self.raw.read(CHUNK_SIZE)
+        if hash:
+          hash.update(data)
       outfile.close()  
     self.close()
 
@@ -25,10 +169,14 @@ class Response:
   def content(self):
     if self._cached is None:
       try:
-        self._cached = self.raw.read()
+        chunks = []
+        data = self._read()
+        while data:
+          chunks.append(data)
+          data = self._read()
+        self._cached = b''.join(chunks)
       finally:
-        self.raw.close()
-        self.raw = None
+        self._release()
     return self._cached
 
   @property
@@ -40,13 +188,252 @@ class Response:
     return ujson.loads(self.content)
 
 
-def request(method, url, data=None, json=None, headers={}, stream=None, timeout=5, logger=None):
+class AsyncResponse(Response):
+  # Same framing as Response, read through an asyncio stream. content and
+  # text are awaitable: `await resp.text`, `await resp.json()`.
+  def __init__(self, stream, timeout=None):
+    super().__init__(stream)
+    # Seconds any single body read may take
+    self.timeout = timeout
+
+  def _wait(self, awaitable):
+    # A server stalling after the head would otherwise hang the caller
+    if self.timeout is None:
+      return awaitable
+    import asyncio
+    return asyncio.wait_for(awaitable, self.timeout)
+
+  def _release(self):
+    # Async connections aren't pooled
+    if self.raw:
+      self.raw.close()
+      self.raw = None
+
+  async def _anextChunk(self):
+    if self._crlf:
+      await self._wait(self.raw.readline()) # CRLF after the previous chunk's data
+    if not self._chunk(await self._wait(self.raw.readline())):
+      # Skip trailers up to the final empty line
+      while True:
+        l = await self._wait(self.raw.readline())
+        if not l or l == b"\r\n":
+          break
+
+  async def _alimit(self, n):
+    if self._chunked and self._chunkLeft == 0 and self._remaining != 0 and self.raw:
+      await self._anextChunk()
+    return self._left(n)
+
+  async def read(self, n=-1):
+    n = await self._alimit(n)
+    if n == 0:
+      return b''
+    data = await self._wait(self.raw.read(n))
+    self._advance(len(data))
+    return data
+
+  async def readinto(self, buf):
+    n = await self._alimit(len(buf))
+    if n == 0:
+      return 0
+    n = await self._wait(self.raw.readinto(buf if n == len(buf) else memoryview(buf)[:n])) or 0
+    self._advance(n)
+    return n
+
+  async def save(self, file, buf=512):
+    if isinstance(buf, int):
+      buf = bytearray(buf)
+    mv = memoryview(buf)
+    try:
+      with open(file, 'wb') as outfile:
+        n = await self.readinto(mv)
+        while n:
+          outfile.write(mv[:n])
+          n = await self.readinto(mv)
+        outfile.close()
+    finally:
+      self.close()
+
+  async def _content(self):
+    if self._cached is None:
+      try:
+        chunks = []
+        data = await self.read()
+        while data:
+          chunks.append(data)
+          data = await self.read()
+        self._cached = b''.join(chunks)
+      finally:
+        self._release()
+    return self._cached
+
+  async def _text(self):
+    return str(await self._content(), self.encoding)
+
+  @property
+  def content(self):
+    return self._content()
+
+  @property
+  def text(self):
+    return self._text()
+
+  async def json(self):
+    import ujson
+    return ujson.loads(await self._content())
+
+
+class Session:
+  def __init__(self, poolSize=1):
+    self.poolSize = poolSize # idle connections kept per host
+    self._pool = {}
+
+  def _get(self, key):
+    pool = self._pool.get(key)
+    if pool:
+      return pool.pop()
+    return None
+
+  def _put(self, key, s):
+    pool = self._pool.setdefault(key, [])
+    if len(pool) < self.poolSize:
+      pool.append(s)
+    else:
+      s.close()
+
+  def close(self):
+    for key in self._pool:
+      for s in self._pool[key]:
+        s.close()
+    self._pool = {}
+
+  def request(self, method, url, **kw):
+    return request(method, url, session=self, **kw)
+
+  def head(self, url, **kw):
+    return self.request("HEAD", url, **kw)
+
+  def get(self, url, **kw):
+    return self.request("GET", url, **kw)
+
+  def post(self, url, **kw):
+    return self.request("POST", url, **kw)
+
+  def put(self, url, **kw):
+    return self.request("PUT", url, **kw)
+
+  def patch(self, url, **kw):
+    return self.request("PATCH", url, **kw)
+
+  def delete(self, url, **kw):
+    return self.request("DELETE", url, **kw)
+
+  # Async requests always open their own connection, asyncio streams can't
+  # share the pooled sockets. These only spare code holding a Session (like
+  # the app) from importing the module for them.
+  async def arequest(self, method, url, **kw):
+    return await arequest(method, url, **kw)
+
+  async def aget(self, url, **kw):
+    return await arequest("GET", url, **kw)
+
+  async def apost(self, url, **kw):
+    return await arequest("POST", url, **kw)
+
+
+class Resolver:
+  def __init__(self, size=4, ttl=300):
+    self.size = size # cached (host, port) pairs
+    self.ttl = ttl # seconds
+    self.hits = 0
+    self.misses = 0
+    self._cache = {}
+
+  def resolve(self, host, port):
+    import usocket, time
+
+    key = (host, port)
+    now = time.ticks_ms()
+    entry = self._cache.get(key)
+    if entry and time.ticks_diff(entry[0], now) > 0:
+      self.hits += 1
+      return entry[1]
+
+    self.misses += 1
+    ai = usocket.getaddrinfo(host, port, 0, usocket.SOCK_STREAM)
+    ai = ai[0]
+
+    if not entry and len(self._cache) >= self.size:
+      # Evict whichever entry expires first
+      oldest = None
+      for k in self._cache:
+        if oldest is None or time.ticks_diff(self._cache[k][0], self._cache[oldest][0]) < 0:
+          oldest = k
+      del self._cache[oldest]
+    self._cache[key] = (time.ticks_add(now, self.ttl * 1000), ai)
+    return ai
+
+  def invalidate(self, host, port):
+    self._cache.pop((host, port), None)
+
+  def clear(self):
+    self._cache = {}
+
+resolver = Resolver()
+
+
+class TLS:
+  # Times TLS handshakes. Sessions can't be resumed: MicroPython's ssl takes no
+  # session and exposes none, so the pooled keep-alive connections are what
+  # saves handshakes.
+  def __init__(self):
+    self.handshakes = 0
+    self.lastHandshake = None # ms
+
+  def wrap(self, s, host, port, log):
+    import ssl, time
+
+    start = time.ticks_ms()
+    s = ssl.wrap_socket(s, server_hostname=host)
+    self.handshakes += 1
+    self.lastHandshake = time.ticks_diff(time.ticks_ms(), start)
+    log('%s %dms' % (host, self.lastHandshake), name='handshake')
+    return s
+
+tls = TLS()
+
+
+# Methods a stale pooled connection may be retried for
+_IDEMPOTENT = ("GET", "HEAD", "OPTIONS")
+# Errors writing to a connection the server already closed: EPIPE,
+# ECONNABORTED, ECONNRESET, ENOTCONN and mbedtls' send failed and reset
+_STALE = (32, 103, 104, 107, -0x4E, -0x50)
+
+
+def _connect(proto, host, port, timeout, log):
   import usocket
 
-  log = lambda *args, **kargs: args
-  if logger:
-    log = logger(append='request')
+  ai = resolver.resolve(host, port)
 
+  s = usocket.socket(ai[0], ai[1], ai[2])
+  s.settimeout(timeout)
+  try:
+    log('%s:%s' % (host, port), name='connect')
+    try:
+      s.connect(ai[-1])
+    except OSError:
+      # The cached address may be stale, look it up again next time
+      resolver.invalidate(host, port)
+      raise
+    if proto == "https:":
+      s = tls.wrap(s, host, port, log)
+  except OSError:
+    s.close()
+    raise
+  return s
+
+
+def _url(url):
   try:
     proto, dummy, host, path = url.split("/", 3)
   except ValueError:
@@ -55,7 +442,6 @@ def request(method, url, data=None, json=None, headers={}, stream=None, timeout=
   if proto == "http:":
     port = 80
   elif proto == "https:":
-    import ssl
     port = 443
   else:
     raise ValueError("Unsupported protocol: " + proto)
@@ -63,62 +449,211 @@ def request(method, url, data=None, json=None, headers={}, stream=None, timeout=
   if ":" in host:
     host, port = host.split(":", 1)
     port = int(port)
+  return proto, host, port, path
 
-  ai = usocket.getaddrinfo(host, port, 0, usocket.SOCK_STREAM)
-  ai = ai[0]
 
-  s = usocket.socket(ai[0], ai[1], ai[2])
-  s.settimeout(timeout)
-  try:
-    log('%s %s %s' % (method, host, path), name='connect')
-    s.connect(ai[-1])
-    if proto == "https:":
-      s = ssl.wrap_socket(s, server_hostname=host)
-    s.write(b"%s /%s HTTP/1.0\r\n" % (method, path))
-    if not "Host" in headers:
-      s.write(b"Host: %s\r\n" % host)
-    # Iterate over keys to avoid tuple alloc
-    for k in headers:
-      s.write(k)
-      s.write(b": ")
-      s.write(headers[k])
-      s.write(b"\r\n")
-    s.write(b'User-Agent: MicroPython Client\r\n')
-    if json is not None:
-      assert data is None
-      import ujson
-      data = ujson.dumps(json)
-      s.write(b"Content-Type: application/json\r\n")
-    if data:
-      s.write(b"Content-Length: %d\r\n" % len(data))
-    s.write(b"\r\n")
-    if data:
-      s.write(data)
-
-    l = s.readline()
-    #print(l)
-    l = l.split(None, 2)
-    status = int(l[1])
-    reason = ""
-    if len(l) > 2:
-      reason = l[2].rstrip()
-    while True:
+def _head(method, host, path, headers, data, json, close, decode):
+  # Build the whole request head up front so it goes out in a single write
+  # (and a single TLS record) instead of one per header line
+  head = ["%s /%s HTTP/1.1\r\n" % (method, path)]
+  if not "Host" in headers:
+    head.append("Host: %s\r\n" % host)
+  if close:
+    head.append("Connection: close\r\n")
+  # Iterate over keys to avoid tuple alloc
+  for k in headers:
+    head.append("%s: %s\r\n" % (k, headers[k]))
+  head.append("User-Agent: MicroPython Client\r\n")
+  if decode and not "Accept-Encoding" in headers:
+    head.append("Accept-Encoding: gzip, deflate\r\n")
+  if json is not None:
+    assert data is None
+    import ujson
+    data = ujson.dumps(json)
+    head.append("Content-Type: application/json\r\n")
+  if isinstance(data, str):
+    data = data.encode()
+  if data:
+    head.append("Content-Length: %d\r\n" % len(data))
+  head.append("\r\n")
+  return "".join(head).encode(), data
+
+
+def _status(resp, l):
+  #print(l)
+  l = l.split(None, 2)
+  resp._version = l[0]
+  resp.status_code = int(l[1])
+  resp.reason = ""
+  if len(l) > 2:
+    resp.reason = l[2].rstrip()
+
+
+def _header(resp, l):
+  # Returns False at the empty line ending the headers
+  if not l or l == b"\r\n":
+    return False
+  #print(l)
+  k, v = l.split(b":", 1)
+  resp.headers[k.decode().strip().lower()] = v.decode().strip()
+  return True
+
+
+def _frame(resp, method):
+  # Works out where the body ends and whether the connection survives it
+  status = resp.status_code
+  if method == "HEAD" or status in (204, 304) or 100 <= status <= 199:
+    resp._remaining = 0
+  elif "chunked" in resp.headers.get("transfer-encoding", "").lower():
+    resp._chunked = True
+  elif "content-length" in resp.headers:
+    resp._remaining = int(resp.headers["content-length"])
+
+  connection = resp.headers.get("connection", "").lower()
+  if resp._version == b"HTTP/1.1":
+    resp._keepAlive = connection != "close"
+  else:
+    resp._keepAlive = connection == "keep-alive"
+
+
+def _location(resp, url):
+  # Where a redirect points to, None if resp isn't one
+  if resp.status_code in (301, 302, 303, 307, 308) and "location" in resp.headers:
+    location = resp.headers["location"]
+    if location.startswith("/"):
+      location = "/".join(url.split("/", 3)[:3]) + location
+    return location
+  return None
+
+
+def request(method, url, data=None, json=None, headers={}, stream=None, timeout=5, logger=None, session=None, decode=False, redirects=3):
+  log = lambda *args, **kargs: args
+  if logger:
+    log = logger(append='request')
+
+  proto, host, port, path = _url(url)
+  head, body = _head(method, host, path, headers, data, json, not session, decode and deflate)
+
+  key = (proto, host, port)
+  s = session._get(key) if session else None
+  # A pooled connection may have been closed by the server while idle. Then
+  # the request is retried once on a fresh connection, but only if it is
+  # safe to repeat and clearly never reached the server.
+  reused = s is not None and method in _IDEMPOTENT
+
+  while True:
+    if s is None:
+      s = _connect(proto, host, port, timeout, log)
+    stale = False
+    try:
+      log('%s %s %s' % (method, host, path), name='send')
+      try:
+        s.write(head)
+        if body:
+          s.write(body)
+      except OSError as e:
+        stale = e.args[0] in _STALE
+        raise
+
       l = s.readline()
-      if not l or l == b"\r\n":
-        break
-      #print(l)
-      if l.startswith(b"Transfer-Encoding:"):
-        if b"chunked" in l:
-          raise ValueError("Unsupported " + l)
-      elif l.startswith(b"Location:") and not 200 <= status <= 299:
-        raise NotImplementedError("Redirects not yet supported")
-  except OSError:
+      if not l:
+        stale = True
+        raise OSError("Connection closed")
+      break
+    except OSError:
+      s.close()
+      s = None
+      if not (reused and stale):
+        raise
+      reused = False
+
+  resp = Response(s, session=session, key=key)
+  try:
+    _status(resp, l)
+    while _header(resp, s.readline()):
+      pass
+    _frame(resp, method)
+  except Exception:
     s.close()
     raise
 
-  resp = Response(s)
-  resp.status_code = status
-  resp.reason = reason
+  location = _location(resp, url)
+  if location:
+    if not redirects:
+      resp.close()
+      raise ValueError("Too many redirects")
+    # Read the (small) body so the connection can be reused
+    resp.content
+    resp.close()
+    log('%s -> %s' % (resp.status_code, location), name='redirect')
+    if resp.status_code == 303:
+      method, data, json = "GET", None, None
+    return request(method, location, data=data, json=json, headers=headers, stream=stream, timeout=timeout, logger=logger, session=session, decode=decode, redirects=redirects - 1)
+
+  if decode and deflate and resp._remaining != 0 and resp.headers.get("content-encoding", "").lower() in ("gzip", "deflate"):
+    # The window buffer is sized by the stream header, up to 32 KB. That's why
+    # callers opt in with decode=True, only where the body is much larger.
+    resp._decoder = deflate.DeflateIO(_Body(resp), deflate.AUTO)
+  return resp
+
+
+async def _arequest(method, proto, host, port, path, head, data, timeout, log):
+  import asyncio
+
+  # open_connection() looks the host up itself, the resolver can't help here
+  log('%s:%s' % (host, port), name='connect')
+  if proto == "https:":
+    stream = (await asyncio.open_connection(host, port, ssl=True, server_hostname=host))[0]
+  else:
+    stream = (await asyncio.open_connection(host, port))[0]
+
+  resp = AsyncResponse(stream, timeout)
+  try:
+    log('%s %s %s' % (method, host, path), name='send')
+    stream.write(head)
+    if data:
+      stream.write(data)
+    await stream.drain()
+
+    l = await stream.readline()
+    if not l:
+      raise OSError("Connection closed")
+    _status(resp, l)
+    while _header(resp, await stream.readline()):
+      pass
+    _frame(resp, method)
+  except BaseException:
+    # Also closes the stream when the request is cancelled or times out
+    stream.close()
+    raise
+  return resp
+
+
+async def arequest(method, url, data=None, json=None, headers={}, timeout=30, logger=None, redirects=3):
+  import asyncio
+
+  log = lambda *args, **kargs: args
+  if logger:
+    log = logger(append='arequest')
+
+  proto, host, port, path = _url(url)
+  # Bodies can't be inflated while reading asynchronously, ask for identity
+  head, body = _head(method, host, path, headers, data, json, True, False)
+  # Unlike the per-socket timeout of request(), this covers the whole
+  # connect, TLS handshake and response head. The body is read by the
+  # caller, every read with the same timeout.
+  resp = await asyncio.wait_for(_arequest(method, proto, host, port, path, head, body, timeout, log), timeout)
+
+  location = _location(resp, url)
+  if location:
+    # Async connections aren't pooled, so the body can just be dropped
+    resp.close()
+    if not redirects:
+      raise ValueError("Too many redirects")
+    log('%s -> %s' % (resp.status_code, location), name='redirect')
+    if resp.status_code == 303:
+      method, data, json = "GET", None, None
+    return await arequest(method, location, data=data, json=json, headers=headers, timeout=timeout, logger=logger, redirects=redirects - 1)
   return resp
 
 
@@ -139,3 +674,22 @@ def patch(url, **kw):
 
 def delete(url, **kw):
   return request("DELETE", url, **kw)
+
+
+async def ahead(url, **kw):
+  return await arequest("HEAD", url, **kw)
+
+async def aget(url, **kw):
+  return await arequest("GET", url, **kw)
+
+async def apost(url, **kw):
+  return await arequest("POST", url, **kw)
+
+async def aput(url, **kw):
+  return await arequest("PUT", url, **kw)
+
+async def apatch(url, **kw):
+  return await arequest("PATCH", url, **kw)
+
+async def adelete(url, **kw):
+  return await arequest("DELETE", url, **kw)
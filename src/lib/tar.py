@@ -0,0 +1,91 @@
+# Streaming reader for ustar/pax tar archives (as produced by git archive).
+# Members are read in order straight from the stream, nothing is buffered
+# except the 512 byte header block.
+
+BLOCK = 512
+
+def _str(b):
+  return bytes(b).split(b'\0', 1)[0].decode()
+
+class Reader:
+  def __init__(self, stream):
+    self.stream = stream
+    self.header = bytearray(BLOCK)
+    self._left = 0 # data bytes left in the current member
+    self._pad = 0
+
+  def _fill(self, buf):
+    # Reads exactly len(buf) bytes, a stream may return less per call
+    mv = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+      n = self.stream.readinto(mv[pos:])
+      if not n:
+        raise ValueError('Unexpected end of tar archive')
+      pos += n
+
+  def _skip(self):
+    # Discards what's left of the current member and its padding
+    n = self._left + self._pad
+    mv = memoryview(self.header)
+    while n:
+      k = n if n < BLOCK else BLOCK
+      self._fill(mv[:k])
+      n -= k
+    self._left = 0
+    self._pad = 0
+
+  def _data(self):
+    # Whole content of a (small) metadata member
+    data = bytearray(self._left)
+    self._fill(data)
+    self._left = 0
+    return bytes(data)
+
+  def readinto(self, buf):
+    # Reads data of the member last yielded, 0 once it is exhausted
+    n = len(buf) if len(buf) < self._left else self._left
+    if not n:
+      return 0
+    n = self.stream.readinto(buf if n == len(buf) else memoryview(buf)[:n])
+    if not n:
+      raise ValueError('Unexpected end of tar archive')
+    self._left -= n
+    return n
+
+  def __iter__(self):
+    # Yields (name, isDir, size) for every file and directory
+    name = None
+    while True:
+      self._skip()
+      self._fill(self.header)
+      h = self.header
+      if not h[0]:
+        return # End of archive marker
+
+      size = int(_str(h[124:136]).strip() or '0', 8)
+      kind = h[156]
+      self._left = size
+      self._pad = -size % BLOCK
+
+      if kind == 0x78: # x: pax header for the next member
+        for record in self._data().split(b'\n'):
+          if b' path=' in record:
+            name = record.split(b' path=', 1)[1].decode()
+        continue
+      if kind == 0x4c: # L: GNU long name for the next member
+        name = _str(self._data())
+        continue
+      if kind == 0x67: # g: pax global header (git stores the commit here)
+        continue
+
+      if name is None:
+        name = _str(h[0:100])
+        if bytes(h[257:262]) == b'ustar' and h[345]:
+          name = _str(h[345:500]) + '/' + name
+
+      if kind == 0x35: # 5: directory
+        yield (name.rstrip('/'), True, 0)
+      elif kind in (0, 0x30): # 0: regular file
+        yield (name, False, size)
+      name = None
@@ -1,29 +1,94 @@
-
 days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
 months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
+REANCHOR = 3600 # seconds, keeps ticks_diff far from the ticks_ms wrap around
+MAXDRIFT = 500e-6 # seconds per second, far beyond any crystal, caps a bad estimate
+
+# rp2 floats are single precision, only good to about 128 s at the size of
+# epoch seconds. The anchor is kept as integer seconds and milliseconds and
+# drift is only ever applied to elapsed milliseconds.
+
 class Time:
   def __init__(self, time=None):
     self._time = time
+    # Last formatted second, most log lines fall into the same one
+    self._isoSecs = None
+    self._iso = None
+    # Drift of the ticks_ms clock against NTP, in seconds per second
+    self.drift = 0
+    self._synced = None
+    self.sync()
 
   def time(self):
     return self._time.time()
 
+  def sync(self, secs=None):
+    # Anchors the monotonic clock to the RTC, call right after ntptime.settime()
+    ticks = self._time.ticks_ms()
+    if secs is None:
+      secs = self._time.time()
+    secs = int(secs)
+    if self._synced is not None:
+      elapsed = self._time.ticks_diff(ticks, self._syncTicks)
+      # NTP and the RTC only have whole seconds, so learn over long spans only
+      if elapsed >= REANCHOR * 1000:
+        # Milliseconds the free running clock was off since the last sync
+        error = (secs - self._anchor) * 1000 - self._offset(ticks)
+        self.drift = min(MAXDRIFT, max(-MAXDRIFT, self.drift + error / elapsed))
+    self._synced = secs
+    self._syncTicks = ticks
+    self._anchor = secs
+    self._anchorMs = 0
+    self._anchorTicks = ticks
+
+  def _offset(self, ticks):
+    # Milliseconds from the anchor second to ticks, drift corrected
+    elapsed = self._time.ticks_diff(ticks, self._anchorTicks)
+    if elapsed > REANCHOR * 1000:
+      ms = self._anchorMs + elapsed + int(elapsed * self.drift)
+      self._anchor += ms // 1000
+      self._anchorMs = ms % 1000
+      self._anchorTicks = ticks
+      elapsed = 0
+    return self._anchorMs + elapsed + int(elapsed * self.drift)
+
+  def now(self):
+    # Whole seconds since the epoch from ticks_ms, never jumps when the RTC is set
+    ms = self._offset(self._time.ticks_ms())
+    return self._anchor + ms // 1000
+
+  def until(self, interval):
+    # Seconds until the next multiple of interval on the monotonic clock
+    period = interval * 1000
+    ms = self._offset(self._time.ticks_ms())
+    return (period - (self._anchor % interval * 1000 + ms) % period) / 1000
+
   def sleep(self, n):
     return self._time.sleep(n)
 
+  def ticks_ms(self):
+    return self._time.ticks_ms()
+
+  def ticks_add(self, ticks, delta):
+    return self._time.ticks_add(ticks, delta)
+
+  def ticks_diff(self, a, b):
+    return self._time.ticks_diff(a, b)
+
   def localtime(self):
     return self._time.localtime()
 
-  def dateTimeIso(self):
-    t = self._time.localtime()  
-    return "%d-%02d-%02dT%02d:%02d:%02dZ" % (t[0], t[1], t[2], t[3], t[4], t[5])
+  def dateTimeIso(self, secs=None):
+    secs = int(self._time.time() if secs is None else secs)
+    if secs != self._isoSecs:
+      t = self._time.localtime(secs)
+      self._iso = "%d-%02d-%02dT%02d:%02d:%02dZ" % (t[0], t[1], t[2], t[3], t[4], t[5])
+      self._isoSecs = secs
+    return self._iso
 
   def human(self):
-    t = self._time.localtime()  
+    t = self._time.localtime()
     return "%s, %d %s %d %02d:%02d:%02d UTC" % (days[t[6]], t[2], months[t[1]-1], t[0], t[3], t[4], t[5])
 
   def sleep_us(self, n):
     return self._time.sleep_us(n)
-    
-
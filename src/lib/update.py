@@ -1,9 +1,11 @@
-import machine, asyncio
+import machine, asyncio, json, time, hashlib, binascii
 
 class IO:
-  def __init__(self, os=None, logger=None):
+  def __init__(self, os=None, logger=None, bufferSize=512):
     self.os = os
     self.log = logger(append='io')
+    # Shared by copies and downloads so streaming never allocates per chunk
+    self.buf = bytearray(bufferSize)
 
   def rmtree(self, path):
     if not self.exists(path):
@@ -24,19 +26,21 @@ class IO:
 
   def copy(self, fromPath, toPath):
     self.log('Copying [%s] to [%s]' % (fromPath, toPath))
-    if not self.exists(toPath):
-      self.mkdir(toPath)
-
-    for entry in self.os.ilistdir(fromPath):
-      self.copy(fromPath + '/' + entry[0], toPath + '/' + entry[0])
-
-    with open(fromPath) as fromFile:
-      with open(toPath, 'w') as toFile:
-        CHUNK_SIZE = 512 # bytes
-        data = fromFile.read(CHUNK_SIZE)
-        while data:
-          toFile.write(data)
-          data = fromFile.read(CHUNK_SIZE)
+    if self.os.stat(fromPath)[0] & 0x4000:
+      if not self.exists(toPath):
+        self.mkdir(toPath)
+
+      for entry in self.os.ilistdir(fromPath):
+        self.copy(fromPath + '/' + entry[0], toPath + '/' + entry[0])
+      return
+
+    mv = memoryview(self.buf)
+    with open(fromPath, 'rb') as fromFile:
+      with open(toPath, 'wb') as toFile:
+        n = fromFile.readinto(mv)
+        while n:
+          toFile.write(mv[:n])
+          n = fromFile.readinto(mv)
       toFile.close()
     fromFile.close()
 
@@ -64,6 +68,101 @@ class IO:
   def path(self, *args):
     return '/'.join(args).replace('//', '/').lstrip('/').rstrip('/')
 
+  def size(self, path):
+    # Size of a file in bytes, 0 if it doesn't exist
+    try:
+      return self.os.stat(path)[6]
+    except OSError:
+      return 0
+
+  def hash(self, path, hash):
+    # Feeds the contents of a file into a hashlib object
+    mv = memoryview(self.buf)
+    with open(path, 'rb') as file:
+      n = file.readinto(mv)
+      while n:
+        hash.update(mv[:n])
+        n = file.readinto(mv)
+      file.close()
+
+def unixOffset():
+  # Seconds from the Unix epoch to the firmware's, which is 2000 on older ports
+  return sum(366 if year % 4 == 0 else 365 for year in range(1970, time.gmtime(0)[0])) * 86400
+
+def precompiled(path, seen):
+  # MicroPython imports x.py before x.mpy, so a source file is left out when
+  # the release ships its bytecode. Git sorts x.mpy before x.py, so this works
+  # on listings while they stream; seen collects the .mpy paths.
+  if path.endswith('.mpy'):
+    seen.add(path[:-4])
+  elif path.endswith('.py') and path[:-3] in seen:
+    return True
+  return False
+
+class Journal:
+  # Download progress of one version, so an interrupted update continues
+  # where it stopped. The first line is the commit, followed by
+  # "<blob> <size> <path>" for every completed file. How much of a partial
+  # file was written is read from the file itself. A last line "complete"
+  # marks a finished download that is waiting to be activated.
+  def __init__(self, io, path):
+    self.io = io
+    self.path = path
+    self.done = {}
+    self.complete = False
+
+  def load(self):
+    # Returns the commit the journal belongs to, None without a journal
+    self.done = {}
+    self.complete = False
+    try:
+      with open(self.path) as file:
+        sha = file.readline().rstrip('\n')
+        for line in file:
+          if line == 'complete\n':
+            self.complete = True
+            continue
+          (blob, size, path) = line.rstrip('\n').split(' ', 2)
+          self.done[path] = blob
+        file.close()
+      return sha or None
+    except OSError:
+      return None
+
+  def resume(self, sha):
+    # Returns True if the journal belongs to a download of sha
+    if self.load() == sha:
+      return True
+    self.done = {}
+    self.complete = False
+    return False
+
+  def start(self, sha):
+    self.done = {}
+    self.complete = False
+    self.io.writeFile(self.path, sha + '\n')
+
+  def finish(self):
+    self.complete = True
+    with open(self.path, 'a') as file:
+      file.write('complete\n')
+      file.close()
+
+  def isDone(self, path, blob):
+    return self.done.get(path) == blob
+
+  def complete(self, path, blob, size):
+    self.done[path] = blob
+    with open(self.path, 'a') as file:
+      file.write('%s %d %s\n' % (blob, size, path))
+      file.close()
+
+  def remove(self):
+    try:
+      self.io.os.remove(self.path)
+    except OSError:
+      pass
+
 class OTAUpdater:
 
   def __init__(
@@ -71,26 +170,48 @@ class OTAUpdater:
     mainDir='src',
     nextDir='next',
     versionFile='.version',
+    manifestFile='.manifest',
+    journalFile='.journal',
     machine=None,
     io=None,
     github=None,
     logger=None,
+    mode='files',
+    slots=None,
+    archiveTime=300,
   ):
     self.github = github
+    # The slot module, when set new versions go into the inactive code slot
+    # instead of replacing mainDir in place
+    self.slots = slots
+    # files: walk the contents API, archive: a single tarball,
+    # delta: only blobs that changed according to the manifest
+    self.mode = mode
+    # Seconds a whole archive download may take, less budget than that skips it
+    self.archiveTime = archiveTime
     self.mainDir = mainDir
     self.nextDir = nextDir
     self.versionFile = versionFile
+    # Blob SHA and path of every file in mainDir, one "<sha> <path>" per line
+    self.manifestFile = manifestFile
+    self.journalFile = journalFile
     self.machine = machine
     self.io = io
     self.log = logger
+    # SHA of a completely downloaded version waiting for activate()
+    self.staged = None
 
-  def compare(self):
-    self.log('Pulling down remote... ')
-    localSha = None
+  def version(self):
+    # SHA of the running version, None if unknown
     try:
-      localSha = self.io.readFile('%s/%s' % (self.mainDir, self.versionFile))
+      return self.io.readFile('%s/%s' % (self.currentDir(), self.versionFile))
     except:
       self.log('No version file found.', name="compare")
+      return None
+
+  def compare(self):
+    self.log('Pulling down remote... ')
+    localSha = self.version()
 
     remoteSha = self.github.sha()
 
@@ -98,65 +219,476 @@ class OTAUpdater:
     self.log('Remote SHA: ', remoteSha)
     return (localSha, remoteSha)
 
+  def pending(self, localSha, remoteSha):
+    # No remote SHA means the check was deferred by the GitHub rate limit
+    if remoteSha is None or localSha == remoteSha:
+      return False
+    if self.slots and self.slots.read().get('failed') == remoteSha:
+      self.log('Version %s was rolled back before, skipping it' % remoteSha)
+      return False
+    return True
+
   def checkForUpdate(self):
     (localSha, remoteSha) = self.compare()
-    if localSha != remoteSha:
+    if self.pending(localSha, remoteSha):
       # Reset the device so we don't have to worry about the watchdog
       self.machine.reset()
 
-  def update(self):
-    (localSha, remoteSha) = self.compare()
-    if localSha == remoteSha:
+  def currentDir(self):
+    # Local directory of the running version
+    if self.slots:
+      return self.io.path(self.slots.read()['active'], self.mainDir)
+    return self.mainDir
+
+  def journal(self):
+    # Journal of the download in the staging directory
+    return Journal(self.io, self.io.path(self.stagingDir().split('/')[0], self.journalFile))
+
+  def stagingDir(self):
+    # Local directory the next version is downloaded into
+    if self.slots:
+      return self.io.path(self.slots.other(self.slots.read()['active']), self.mainDir)
+    return self.nextDir
+
+  def prepare(self, sha):
+    # Generator downloading sha into the staging directory, yields after every
+    # file so the caller can stop between files (the journal picks up there)
+    current = self.currentDir()
+    staging = self.stagingDir()
+    root = staging.split('/')[0]
+    journal = self.journal()
+    if self.slots:
+      state = self.slots.read()
+      if state['previous'] == root:
+        if not state['confirmed']:
+          raise Exception('[%s] is kept for rollback, not staging into it' % root)
+        # Taking over the previous slot, collect() has nothing left to remove
+        self.slots.release()
+    resumed = journal.resume(sha)
+    if resumed and journal.complete:
+      # Finished before a reboot, only the switch is left
+      self.log('Version %s is already downloaded' % sha)
       return
+    if resumed and self.mode != 'archive':
+      self.log('Resuming download, %d files already done' % len(journal.done))
+    else:
+      # Clear whatever is left of an older version (in slot mode the whole slot)
+      self.io.rmtree(root)
+      self.io.mkdir(root)
+      if staging != root:
+        self.io.mkdir(staging)
+      journal.start(sha)
+
+    if self.mode == 'delta':
+      yield from self.downloadDelta(sha, current, staging, journal)
+    elif self.mode == 'archive':
+      yield from self.github.downloadArchive(sha, staging, base=self.mainDir)
+    else:
+      yield from self.github.download(sha, staging, base=self.mainDir, journal=journal)
+    self.io.writeFile(staging + '/' + self.versionFile, sha)
+    # Kept until activate(), so the download survives a reboot
+    journal.finish()
+
+  def stage(self, budget=None):
+    # Downloads the next version without switching to it. With a budget (in
+    # seconds) it stops after the first file past it and the next call
+    # continues. Returns True once a complete version is staged.
+    if self.staged:
+      return True
+    if self.slots and not self.slots.read()['confirmed']:
+      # The other slot is the rollback target until this version confirms itself
+      self.log('Running version is not confirmed yet, staging later', name='stage')
+      return False
+    if budget is not None and self.mode == 'archive' and budget < self.archiveTime:
+      # An archive can't be continued, it has to fit in one go
+      self.log('%d seconds are too few for the archive, staging later' % budget, name='stage')
+      return False
+    (localSha, remoteSha) = self.compare()
+    if not self.pending(localSha, remoteSha):
+      return False
+
+    # An archive running over is abandoned and starts over next time
+    deadline = None
+    if budget is not None:
+      deadline = time.ticks_add(time.ticks_ms(), int(budget * 1000))
+    steps = self.prepare(remoteSha)
+    try:
+      for _ in steps:
+        if deadline is not None and time.ticks_diff(deadline, time.ticks_ms()) <= 0:
+          self.log('Out of time, staging continues later', name='stage')
+          return False
+    finally:
+      # Closes the open listing or tree response when stopped early
+      steps.close()
+    self.log('Version %s is staged' % remoteSha, name='stage')
+    self.staged = remoteSha
+    return True
+
+  def recover(self):
+    # Picks up a version downloaded completely before the last reboot, without
+    # the network. Returns True when there is one to activate.
+    if self.staged:
+      return True
+    if self.slots and not self.slots.read()['confirmed']:
+      return False
+    journal = self.journal()
+    sha = journal.load()
+    if sha is None or not journal.complete or not self.pending(self.version(), sha):
+      return False
+    self.log('Version %s was downloaded before the reboot' % sha, name='recover')
+    self.staged = sha
+    return True
 
+  def activate(self):
+    # Switches to the staged version, takes effect on the next reboot
+    self.journal().remove()
+    if self.slots:
+      # A single pointer write, the running slot stays for rollback
+      self.slots.switch(self.stagingDir().split('/')[0])
+    else:
+      self.io.rmtree(self.mainDir)
+      self.io.move(self.nextDir, self.mainDir)
+    self.staged = None
+
+  def update(self):
+    # Returns True once a new version was installed and needs a reboot
     pin = machine.Pin('LED', machine.Pin.OUT)
     led = asyncio.create_task(blink(pin, 0.5))
+    try:
+      if not self.stage():
+        return False
+      self.activate()
+      return True
+    finally:
+      led.cancel()
+      pin.off()
 
-    self.io.rmtree(self.nextDir)
-    self.io.mkdir(self.nextDir)
-    self.github.download(remoteSha, self.nextDir, base=self.mainDir)
-    self.io.writeFile(self.nextDir + '/' + self.versionFile, remoteSha)
-    self.io.rmtree(self.mainDir)
-    self.io.move(self.nextDir, self.mainDir)
+  def confirm(self):
+    # The running version works, stop counting boots towards a rollback
+    if self.slots:
+      self.slots.confirm()
 
-    led.cancel()
-    pin.off()
+  def collect(self):
+    # Deletes the previous slot once the running one is confirmed. Slow on
+    # LittleFS, so it is meant for idle time rather than the update itself.
+    if not self.slots:
+      return
+    state = self.slots.read()
+    if not state['confirmed'] or state['previous'] is None:
+      return
+    previous = state['previous']
+    if previous == self.stagingDir().split('/')[0] and (self.staged or self.io.size(self.io.path(previous, self.journalFile))):
+      self.log('[%s] holds the next version, not removing it' % previous, name='collect')
+      return
+    self.log('Removing previous version in [%s]' % (previous or self.mainDir), name='collect')
+    self.io.rmtree(self.io.path(previous, self.mainDir))
+    if previous:
+      self.io.rmtree(previous)
+    self.slots.release()
+
+  def readManifest(self, directory):
+    manifest = {}
+    try:
+      with open(self.io.path(directory, self.manifestFile)) as file:
+        for line in file:
+          (sha, path) = line.rstrip('\n').split(' ', 1)
+          manifest[path] = sha
+        file.close()
+    except OSError:
+      self.log('No manifest found, downloading all files', name='manifest')
+    return manifest
+
+  def downloadDelta(self, sha, current, staging, journal):
+    manifest = self.readManifest(current)
+    compiled = set()
+    changed = 0
+    patched = 0
+    # The new manifest is written while the tree streams in
+    with open(self.io.path(staging, self.manifestFile), 'w') as out:
+      for entry in self.github.tree(sha, base=self.mainDir):
+        path = entry['path']
+        destination = self.io.path(staging, path)
+        if entry['type'] == 'tree':
+          if not self.io.exists(destination):
+            self.io.mkdir(destination)
+          continue
+        elif entry['type'] != 'blob' or precompiled(path, compiled):
+          continue
+        out.write('%s %s\n' % (entry['sha'], path))
+        if journal.isDone(destination, entry['sha']):
+          continue
+
+        done = False
+        old = manifest.get(path)
+        if old == entry['sha']:
+          try:
+            self.io.copy(self.io.path(current, path), destination)
+            journal.complete(destination, entry['sha'], entry['size'])
+            done = True
+          except OSError as e:
+            self.log('Failed to copy %s, downloading it instead:' % path, e, name='delta')
+        elif old is not None and self.github.patch:
+          done = self.github.downloadPatch(sha, old, self.io.path(current, path), destination, entry['sha'], entry['size'], journal=journal)
+          patched += done
+        if not done:
+          self.github.downloadFile(sha, self.io.path(self.mainDir, path), destination, entry['sha'], entry['size'], journal=journal)
+          changed += 1
+        yield
+      out.close()
+    self.log('Downloaded %d changed files, patched %d' % (changed, patched), name='delta')
 
 class GitHub:
-  def __init__(self, requests=None, remote=None, io=None, logger=None, branch='master', username='', token='', base64=None):
+  def __init__(self, requests=None, remote=None, io=None, logger=None, branch='master', username='', token='', base64=None, jsonstream=None, tar=None, patch=None, patchDir='patches', cacheFile='.github.json'):
     self.requests = requests
+    self.jsonstream = jsonstream
+    self.tar = tar
+    # Delta updates rebuild changed files from patches in patchDir when set
+    self.patch = patch
+    self.patchDir = patchDir
     self.remote = remote.rstrip('/').replace('https://github.com', 'https://api.github.com/repos')
+    self.raw = remote.rstrip('/').replace('https://github.com', 'https://raw.githubusercontent.com')
     self.io = io
     self.log = logger(append='github')
     self.branch = branch
     self.logger = logger
+    # ETag, Last-Modified and rate limit of the last check, kept on flash
+    # outside of the code directory so they survive updates and reboots
+    self.cacheFile = cacheFile
+    try:
+      self.cache = json.loads(self.io.readFile(cacheFile))
+    except:
+      self.cache = {}
 
     if username and token:
       self.headers = {'Authentication': 'Basic %s' % base64.b64encode(b'%s:%s' % (username, token))}
     else:
       self.headers = {}
 
-  def sha(self):    
-    result = self.requests.get('%s/commits?per_page=1&sha=%s' % (self.remote, self.branch), logger=self.logger, headers=self.headers)
-    if result.status_code == 200:
+  def saveCache(self):
+    try:
+      self.io.writeFile(self.cacheFile, json.dumps(self.cache))
+    except Exception as e:
+      self.log('Failed to write cache:', e, name='cache')
+
+  def sha(self):
+    # Returns None while checks are deferred because of the rate limit
+    # The limit resets every hour, anything further out is a bad value (older
+    # versions stored the header in Unix seconds)
+    resetAt = self.cache.get('resetAt', 0)
+    if time.time() < resetAt <= time.time() + 3600:
+      self.log('Rate limit exhausted, deferring check until %d' % resetAt, name='sha')
+      return None
+
+    url = '%s/commits?per_page=1&sha=%s' % (self.remote, self.branch)
+    headers = self.headers
+    if self.cache.get('url') == url:
+      headers = dict(self.headers)
+      if 'etag' in self.cache:
+        headers['If-None-Match'] = self.cache['etag']
+      if 'lastModified' in self.cache:
+        headers['If-Modified-Since'] = self.cache['lastModified']
+
+    result = self.requests.get(url, logger=self.logger, headers=headers)
+    cache = dict(self.cache)
+    sha = None
+    if result.status_code == 304:
+      self.log('Not modified', name='sha')
+      sha = cache['sha']
+      result.close()
+    elif result.status_code == 200:
       sha = result.json()[0]['sha']
-    else:
+      cache['url'] = url
+      cache['sha'] = sha
+      for (key, header) in (('etag', 'etag'), ('lastModified', 'last-modified')):
+        if header in result.headers:
+          cache[key] = result.headers[header]
+        else:
+          cache.pop(key, None)
+    elif result.headers.get('x-ratelimit-remaining') != '0':
+      result.close()
       raise Exception('Unexpected response from GitHub: %d:%s' % (result.status_code, result.reason))
-    result.close()
+    else:
+      result.close()
+
+    if result.headers.get('x-ratelimit-remaining') == '0':
+      cache['resetAt'] = int(result.headers.get('x-ratelimit-reset', 0)) - unixOffset()
+      self.log('Rate limit exhausted until %d' % cache['resetAt'], name='sha')
+    else:
+      cache.pop('resetAt', None)
+
+    if cache != self.cache:
+      self.cache = cache
+      self.saveCache()
     return sha
     
-  def download(self, sha=None, destination=None, currentDir='', base=''):
-    fileList = self.requests.get('%s/contents/%s?ref=%s' % (self.remote, self.io.path(base, currentDir), sha), logger=self.logger, headers=self.headers)
-
-    for file in fileList.json():
-      if file['type'] == 'file':
-        result = self.requests.get(file['download_url'], logger=self.logger, headers=self.headers)
-        result.save(self.io.path(destination, currentDir, file['name']))
-      elif file['type'] == 'dir':
-        self.io.mkdir(self.io.path(destination, currentDir, file['name']))
-        self.download(sha=sha, destination=destination, currentDir=self.io.path(currentDir, file['name']), base=base)
-
-    fileList.close()
+  def download(self, sha=None, destination=None, currentDir='', base='', journal=None):
+    # Listings are large and compress well, worth the inflate window
+    fileList = self.requests.get('%s/contents/%s?ref=%s' % (self.remote, self.io.path(base, currentDir), sha), logger=self.logger, headers=self.headers, decode=True)
+
+    # The listing is parsed while it streams in. Files are downloaded right
+    # away (from another host), directories only once the listing is done.
+    dirs = []
+    compiled = set()
+    try:
+      for file in self.jsonstream.items(fileList, ('type', 'name', 'download_url', 'sha', 'size')):
+        if file['type'] == 'file' and not precompiled(file['name'], compiled):
+          self.fetch(file['download_url'], self.io.path(destination, currentDir, file['name']), file['sha'], file['size'], journal=journal)
+          yield
+        elif file['type'] == 'dir':
+          dirs.append(file['name'])
+    finally:
+      fileList.close()
+
+    for name in dirs:
+      path = self.io.path(destination, currentDir, name)
+      if not self.io.exists(path):
+        self.io.mkdir(path)
+      yield from self.download(sha=sha, destination=destination, currentDir=self.io.path(currentDir, name), base=base, journal=journal)
+
+  def tree(self, sha=None, base=''):
+    # Yields path (relative to base), type, sha and size of every blob and tree
+    # below base in the commit's recursive tree, streamed from the response
+    result = self.requests.get('%s/git/trees/%s?recursive=1' % (self.remote, sha), logger=self.logger, headers=self.headers, decode=True)
+    if result.status_code != 200:
+      result.close()
+      raise Exception('Unexpected response from GitHub: %d:%s' % (result.status_code, result.reason))
+
+    prefix = base.strip('/') + '/' if base else ''
+    try:
+      for entry in self.jsonstream.items(result, ('path', 'type', 'sha', 'size'), path=('tree',)):
+        if entry['path'].startswith(prefix):
+          entry['path'] = entry['path'][len(prefix):]
+          yield entry
+    finally:
+      result.close()
+
+  def downloadFile(self, sha=None, path=None, destination=None, blob=None, size=None, journal=None):
+    # Raw downloads don't count against the API rate limit
+    self.fetch('%s/%s/%s' % (self.raw, sha, path), destination, blob, size, journal=journal)
+
+  def downloadPatch(self, sha=None, old=None, source=None, destination=None, blob=None, size=None, journal=None):
+    # Rebuilds destination from the installed source and a patch between the
+    # two blobs, if the release has one. False means download it instead.
+    try:
+      import deflate
+    except ImportError:
+      # Patches are zlib streams, this firmware can't read them
+      return False
+
+    result = self.requests.get('%s/%s/%s/%s-%s.patch' % (self.raw, sha, self.patchDir, old, blob), logger=self.logger, headers=self.headers)
+    if result.status_code != 200:
+      # Read the (small) 404 body so the connection can be reused
+      try:
+        result.content
+      except OSError:
+        pass
+      result.close()
+      return False
+
+    hash = hashlib.sha1(b'blob %d\0' % size)
+    try:
+      with open(source, 'rb') as previous, open(destination, 'wb') as file:
+        # Patches are zlib streams with a small window
+        self.patch.apply(previous, deflate.DeflateIO(result, deflate.ZLIB), file, self.io.buf, hash)
+      if binascii.hexlify(hash.digest()).decode() != blob:
+        raise ValueError('Checksum mismatch')
+    except Exception as e:
+      self.log('Failed to patch %s, downloading it instead:' % destination, e, name='patch')
+      if self.io.exists(destination):
+        self.io.os.remove(destination)
+      return False
+    finally:
+      result.close()
+    self.log('Patched %s' % destination, name='patch')
+    if journal:
+      journal.complete(destination, blob, size)
+    return True
+
+  def fetch(self, url, destination, blob=None, size=None, retries=3, journal=None):
+    # Saves url to destination while computing its git blob SHA-1
+    # ("blob <size>\0" + content), retrying until it matches blob. With a
+    # journal, completed files are skipped and partial ones continued.
+    if journal and journal.isDone(destination, blob):
+      return
+    if journal and blob is not None and self.io.size(destination) == size:
+      # Written completely, but interrupted before it was journaled
+      hash = hashlib.sha1(b'blob %d\0' % size)
+      self.io.hash(destination, hash)
+      if binascii.hexlify(hash.digest()).decode() == blob:
+        journal.complete(destination, blob, size)
+        return
+
+    for attempt in range(retries):
+      offset = self.io.size(destination) if journal and blob is not None else 0
+      headers = self.headers
+      if 0 < offset < size:
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes=%d-' % offset
+      else:
+        offset = 0
+      # Unencoded, so ranges line up with the file and no inflate window is needed
+      result = self.requests.get(url, logger=self.logger, headers=headers)
+
+      if result.status_code == 200:
+        offset = 0
+      elif result.status_code != 206 or not offset:
+        result.close()
+        raise Exception('Unexpected response from GitHub: %d:%s' % (result.status_code, result.reason))
+      if blob is None:
+        result.save(destination, buf=self.io.buf)
+        return
+
+      hash = hashlib.sha1(b'blob %d\0' % size)
+      if offset:
+        self.log('Resuming %s at %d of %d bytes' % (destination, offset, size), name='fetch')
+        self.io.hash(destination, hash)
+      result.save(destination, buf=self.io.buf, hash=hash, append=bool(offset))
+      if binascii.hexlify(hash.digest()).decode() == blob:
+        if journal:
+          journal.complete(destination, blob, size)
+        return
+      self.log('Checksum mismatch for %s (attempt %d)' % (destination, attempt + 1), name='fetch')
+      # Start the next attempt from scratch
+      self.io.os.remove(destination)
+    raise Exception('Checksum mismatch for %s' % destination)
+
+  def downloadArchive(self, sha=None, destination=None, base=''):
+    import deflate
+
+    # Redirects to a .tar.gz on codeload.github.com
+    result = self.requests.get('%s/tarball/%s' % (self.remote, sha), logger=self.logger, headers=self.headers)
+    if result.status_code != 200:
+      result.close()
+      raise Exception('Unexpected response from GitHub: %d:%s' % (result.status_code, result.reason))
+
+    # Members are named <owner>-<repo>-<sha>/<path>
+    prefix = base.strip('/') + '/' if base else ''
+    mv = memoryview(self.io.buf)
+    compiled = set()
+    try:
+      archive = self.tar.Reader(deflate.DeflateIO(result, deflate.GZIP))
+      for (name, isDir, size) in archive:
+        name = name.split('/', 1)[1] if '/' in name else ''
+        if not name.startswith(prefix) or name == prefix:
+          continue
+        if precompiled(name, compiled):
+          continue
+        path = self.io.path(destination, name[len(prefix):])
+        if isDir:
+          if not self.io.exists(path):
+            self.io.mkdir(path)
+          continue
+
+        self.log('Extracting %s (%d bytes)' % (path, size), name='archive')
+        with open(path, 'wb') as file:
+          n = archive.readinto(mv)
+          while n:
+            file.write(mv[:n])
+            n = archive.readinto(mv)
+          file.close()
+        yield
+    finally:
+      result.close()
 
 async def blink(led, delay):
   while True:
@@ -0,0 +1,197 @@
+# Connects to Wi-Fi as fast as possible: the access point (BSSID and channel)
+# and the DHCP lease of the last good connection are kept on flash, so a
+# reconnect can skip scanning and DHCP. Only when that fails the station scans
+# for the strongest access point of the network and asks DHCP again.
+
+import json, os
+
+class WiFi:
+  def __init__(self, network=None, time=None, ssid='', password='', hostname=None, path='.wifi.json', timeout=30, fastTimeout=5, poll=0.1, leaseTime=12 * 3600):
+    self.network = network
+    self.time = time
+    self.ssid = ssid
+    self.password = password
+    self.hostname = hostname
+    self.path = path
+    self.timeout = timeout
+    # A direct connect either works quickly or not at all
+    self.fastTimeout = fastTimeout
+    self.poll = poll
+    # Seconds a cached IP configuration is reused without asking DHCP
+    self.leaseTime = leaseTime
+    self.wlan = network.WLAN(network.STA_IF)
+    # Milliseconds per phase of the last connect
+    self.timings = {}
+    try:
+      with open(path) as file:
+        self.cache = json.load(file)
+    except:
+      self.cache = {}
+
+  def save(self):
+    with open(self.path + '.tmp', 'w') as file:
+      json.dump(self.cache, file)
+    os.rename(self.path + '.tmp', self.path)
+
+  def forget(self):
+    # Drops the cached access point and lease, e.g. after the network failed
+    self.cache = {}
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+
+  def isconnected(self):
+    return self.wlan.isconnected()
+
+  def connect(self):
+    # Returns True once connected, self.timings tells where the time went
+    if self.wlan.isconnected():
+      return True
+    start = self.time.ticks_ms()
+    self.timings = {}
+    self.wlan.active(True)
+    if self.hostname:
+      try:
+        self.network.hostname(self.hostname)
+      except Exception:
+        pass
+    self.timings['activate'] = self.time.ticks_diff(self.time.ticks_ms(), start)
+
+    connected = False
+    if self.cache.get('bssid'):
+      connected = self.direct()
+    if not connected:
+      connected = self.full()
+
+    self.timings['total'] = self.time.ticks_diff(self.time.ticks_ms(), start)
+    return connected
+
+  def direct(self):
+    # Straight to the cached access point, with the cached lease while it's fresh
+    self.timings['mode'] = 'direct'
+    self.join(bytes(self.cache['bssid']), self.cache.get('channel'))
+    # Set after connect, which would start DHCP again. A negative age means
+    # the RTC was reset, then the lease can't be judged.
+    lease = self.cache.get('ifconfig')
+    if lease and 0 <= self.time.time() - self.cache.get('leased', 0) < self.leaseTime:
+      self.wlan.ifconfig(tuple(lease))
+      self.timings['mode'] = 'direct+lease'
+    if self.wait(self.fastTimeout):
+      if self.timings['mode'] == 'direct':
+        self.remember(self.cache['bssid'], self.cache.get('channel'))
+      return True
+    # Stale access point or lease, start over with a scan and DHCP
+    self.wlan.disconnect()
+    self.wlan.ifconfig('dhcp')
+    return False
+
+  def full(self):
+    self.timings['mode'] = 'scan'
+    start = self.time.ticks_ms()
+    best = None
+    for (ssid, bssid, channel, rssi, security, hidden) in self.wlan.scan():
+      if ssid.decode() == self.ssid and (best is None or rssi > best[3]):
+        best = (ssid, bssid, channel, rssi)
+    self.timings['scan'] = self.time.ticks_diff(self.time.ticks_ms(), start)
+    if best is None:
+      self.wlan.connect(self.ssid, self.password)
+    else:
+      self.join(best[1], best[2])
+    if not self.wait(self.timeout):
+      return False
+    if best is not None:
+      self.remember(list(best[1]), best[2])
+    return True
+
+  def join(self, bssid, channel):
+    # With the channel the cyw43 driver only probes that one for the BSSID
+    if channel:
+      self.wlan.connect(self.ssid, self.password, bssid=bssid, channel=channel)
+    else:
+      self.wlan.connect(self.ssid, self.password, bssid=bssid)
+
+  def remember(self, bssid, channel):
+    # Keeps the access point and the lease DHCP just handed out
+    cache = {
+      'bssid': bssid,
+      'channel': channel,
+      'ifconfig': list(self.wlan.ifconfig()),
+      'leased': self.time.time(),
+    }
+    # Flash is only written when something changed or the lease is half over
+    if cache['bssid'] != self.cache.get('bssid') or cache['ifconfig'] != self.cache.get('ifconfig') or not 0 <= cache['leased'] - self.cache.get('leased', 0) < self.leaseTime / 2:
+      self.cache = cache
+      self.save()
+
+  def wait(self, timeout):
+    # Polls quickly, recording when the link came up and when the IP followed
+    start = self.time.ticks_ms()
+    deadline = timeout * 1000
+    self.timings.pop('associate', None)
+    while True:
+      elapsed = self.time.ticks_diff(self.time.ticks_ms(), start)
+      status = self.wlan.status()
+      if status < 0 or elapsed > deadline:
+        self.timings['failed'] = status
+        return False
+      if status >= 2 and 'associate' not in self.timings:
+        self.timings['associate'] = elapsed
+      if self.wlan.isconnected():
+        self.timings['ip'] = elapsed - self.timings.get('associate', 0)
+        return True
+      self.time.sleep(self.poll)
+
+class Radio:
+  # Powers Wi-Fi only while something needs the network. up() and down()
+  # nest, the interface goes down with the last down(). The time it was on
+  # adds up until cycle() is called, once per measurement cycle.
+  def __init__(self, wifi, time=None, session=None):
+    self.wifi = wifi
+    self.time = time
+    # Pooled connections die with the radio, they are closed on down()
+    self.session = session
+    self.users = 0
+    self.since = None
+    self.onTime = 0
+
+  def up(self):
+    # Returns True once connected
+    if not self.users:
+      self.since = self.time.ticks_ms()
+    self.users += 1
+    if self.wifi.connect():
+      return True
+    self.down()
+    return False
+
+  def down(self):
+    self.users -= 1
+    if self.users > 0:
+      return
+    self.users = 0
+    if self.session:
+      self.session.close()
+    wlan = self.wifi.wlan
+    wlan.disconnect()
+    wlan.active(False)
+    self.onTime += self.time.ticks_diff(self.time.ticks_ms(), self.since)
+    self.since = None
+
+  def __enter__(self):
+    if not self.up():
+      raise OSError('Failed to connect to %s' % self.wifi.ssid)
+    return self
+
+  def __exit__(self, *args):
+    self.down()
+
+  def cycle(self):
+    # Milliseconds the radio was on since the last call
+    onTime = self.onTime
+    if self.since is not None:
+      now = self.time.ticks_ms()
+      onTime += self.time.ticks_diff(now, self.since)
+      self.since = now
+    self.onTime = 0
+    return onTime
@@ -1,5 +1,10 @@
-import src.lib.update as update, env, src.lib.requests as requests, src.lib.logger as logger, src.lib.timew as timew, time, os, machine
-from src.lib import base64
+import src.lib.update as update, env, src.lib.requests as requests, src.lib.logger as logger, src.lib.timew as timew, src.lib.clock as lib_clock, src.lib.wifi as lib_wifi, time, os, machine, ntptime, network
+from src.lib import base64, jsonstream, tar, patch
+try:
+	import slot
+except ImportError:
+	# Root files predate A/B slots, keep updating /src in place
+	slot = None
 
 #gc.enable()
 
@@ -8,38 +13,93 @@ led.off()
 
 t = timew.Time(time=time)
 
-# Configure Logger
-logger = logger.config(enabled=env.settings['debug'], include=env.settings['logInclude'], exclude=env.settings['logExclude'], time=t)
+# Configure Logger. With debug off only warnings and errors are kept, in the
+# sinks that persist them, so field reboots still leave a history.
+debug = env.settings['debug'] in (True, 'True')
+level = logger.LEVELS[env.settings.get('logLevel', 'debug')]
+sinks = [logger.Console(t)] if debug else []
+if not debug:
+	level = max(level, logger.WARN)
+if env.settings.get('logRing'):
+	# Log history that survives resets, written to flash in batches
+	sinks.append(logger.Ring(size=env.settings['logRing'], epoch=time.gmtime(0)[0]))
+if env.settings.get('logFile'):
+	sinks.append(logger.File(t, path=env.settings['logFile']))
+if env.settings.get('logUdp'):
+	sinks.append(logger.UDP(t, *env.settings['logUdp']))
+logger = logger.config(enabled=bool(sinks), include=env.settings['logInclude'], exclude=env.settings['logExclude'], level=level, sinks=sinks, time=t)
 log = logger(append='boot')
 
 loggerOta = logger(append='OTAUpdater')
 
+# NTP with a bounded timeout per server, retried while running until it works
+clock = lib_clock.Clock(ntptime=ntptime, machine=machine, time=time, logger=logger, servers=env.settings.get('ntpServers', lib_clock.SERVERS))
+
+# Keep-alive connections shared by the updater and the main app
+session = requests.Session()
+
+# Wi-Fi is only powered while the network is needed
+wifi = lib_wifi.WiFi(network=network, time=time, ssid=env.settings['wifiAP'], password=env.settings['wifiPassword'], hostname=env.settings['controllerName'])
+radio = lib_wifi.Radio(wifi, time=time, session=session)
+
 io = update.IO(os=os, logger=loggerOta)
 github = update.GitHub(
 	io=io,
 	remote=env.settings['githubRemote'],
 	branch=env.settings['githubRemoteBranch'],
 	logger=loggerOta,
-	requests=requests,
+	requests=session,
 	username=env.settings['githubUsername'],
 	token=env.settings['githubToken'],
 	base64=base64,
+	jsonstream=jsonstream,
+	tar=tar,
+	patch=patch,
+)
+updater = update.OTAUpdater(
+	io=io,
+	github=github,
+	logger=loggerOta,
+	machine=machine,
+	mode=env.settings.get('otaMode', 'files'),
+	slots=slot,
 )
-updater = update.OTAUpdater(io=io, github=github, logger=loggerOta, machine=machine)
 
+# A version downloaded completely before the last reboot is switched to
+# without the network. Downloads only happen in the measurement loop, within
+# the time left until the next measurement.
 try:
-	updater.update()
+	if updater.recover():
+		updater.activate()
+		log.warn('Update installed, rebooting...')
+		log.flush()
+		machine.reset()
 except Exception as e:
-	log('Failed to OTA update:', e)
-	time.sleep(5)
-	machine.reset()
-	pass
+	log.error('Failed to activate update: %s', e)
+
+# Boot window: the time
+if radio.up():
+	log('Connected to network in %s ms: %s' % (wifi.timings.get('total', 0), wifi.timings))
+	try:
+		if clock.sync():
+			t.sync()
+		else:
+			log.warn('Failed to get the time, syncing with NTP later')
+	finally:
+		radio.down()
+else:
+	# No reset, the app still measures (which confirms a new version) and
+	# tries the network again every cycle
+	log.error('Failed to connect to network: %s', wifi.timings)
+	# The cached access point may be gone for good
+	wifi.forget()
 
 try:
 	import src.app.main as app
-	app.Main(env=env, requests=requests, logger=logger, time=t, updater=updater)
+	app.Main(env=env, requests=session, logger=logger, time=t, updater=updater, clock=clock, radio=radio)
 except Exception as e:
-	log('Failed to start main app:', e)
+	log.error('Failed to start main app: %s', e)
+	log.flush()
 	time.sleep(5)
 	machine.reset()
 	pass
\ No newline at end of file
@@ -1,4 +1,4 @@
-import env, src.lib.requests as requests, src.lib.logger as logger, src.lib.timew as timew, time, machine
+import env, src.lib.requests as requests, src.lib.wifi as lib_wifi, src.lib.logger as logger, src.lib.timew as timew, time, machine, network
 
 led = machine.Pin('LED', machine.Pin.OUT)
 led.off()
@@ -6,13 +6,17 @@ led.off()
 t = timew.Time(time=time)
 
 # Configure Logger
-logger = logger.config(enabled=env.settings['debug'], include=env.settings['logInclude'], exclude=env.settings['logExclude'], time=t)
+logger = logger.config(enabled=env.settings['debug'] in (True, 'True'), include=env.settings['logInclude'], exclude=env.settings['logExclude'], level=env.settings.get('logLevel', 'debug'), time=t)
 log = logger(append='test')
 log('The current time is %s' % t.human())
 
+# Wi-Fi is only powered while the network is needed
+wifi = lib_wifi.WiFi(network=network, time=time, ssid=env.settings['wifiAP'], password=env.settings['wifiPassword'], hostname=env.settings['controllerName'])
+radio = lib_wifi.Radio(wifi, time=time)
+
 try:
     import src.app.main as app
-    app.Main(env=env, requests=requests, logger=logger, time=t, updater=None)
+    app.Main(env=env, requests=requests, logger=logger, time=t, updater=None, radio=radio)
 except Exception as e:
 	log('Failed to start main app:', e)
 	pass
\ No newline at end of file
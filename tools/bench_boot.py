@@ -0,0 +1,101 @@
+# Compares importing the app from .py sources and from .mpy bytecode on the
+# MicroPython unix port, run on a computer:
+#
+#   python tools/bench_boot.py --micropython ~/micropython/ports/unix/build-standard/micropython
+#
+# Every run is a fresh interpreter with the garbage collector disabled while
+# importing, so the allocated bytes are the peak heap the import needs. The
+# same file is the measuring script when it runs under MicroPython.
+
+import sys
+
+# Modules that import on the unix port (the app itself needs the sensors)
+MODULES = (
+	'src.lib.base64',
+	'src.lib.logger',
+	'src.lib.timew',
+	'src.lib.jsonstream',
+	'src.lib.tar',
+	'src.lib.requests',
+	'src.lib.update',
+	'src.app.lib.sds011',
+	'src.app.lib.bmp280',
+)
+
+def measure():
+	import gc, time
+	gc.collect()
+	gc.disable()
+	for name in MODULES:
+		before = gc.mem_alloc()
+		start = time.ticks_us()
+		try:
+			__import__(name)
+		except ImportError as e:
+			print('skip', name, e)
+			continue
+		took = time.ticks_diff(time.ticks_us(), start)
+		allocated = gc.mem_alloc() - before
+		gc.collect()
+		retained = gc.mem_alloc() - before
+		print('%s %d %d %d' % (name, took, allocated, retained))
+		gc.disable()
+
+def run(micropython, directory, runs, heap):
+	import subprocess, statistics
+	samples = {}
+	for _ in range(runs):
+		out = subprocess.run([micropython, '-X', 'heapsize=' + heap, __file__], cwd=directory, capture_output=True, text=True, check=True).stdout
+		for line in out.splitlines():
+			if line.startswith('skip'):
+				print(line, file=sys.stderr)
+				continue
+			(name, took, allocated, retained) = line.split()
+			samples.setdefault(name, []).append((int(took), int(allocated), int(retained)))
+	# Medians per module, time in microseconds and heap in bytes
+	return {name: tuple(statistics.median(s[i] for s in values) for i in range(3)) for (name, values) in samples.items()}
+
+def main():
+	import argparse, os, shutil, tempfile
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	import mpy
+
+	parser = argparse.ArgumentParser(description='Benchmark importing .py against .mpy')
+	parser.add_argument('--micropython', default='micropython')
+	parser.add_argument('--mpy-cross', default='mpy-cross', dest='mpyCross')
+	parser.add_argument('--runs', type=int, default=20)
+	parser.add_argument('--heap', default='256k', help='heap of the unix port, about the size of the Pico W')
+	args = parser.parse_args()
+	# Runs happen in a temporary directory, so resolve a relative path first
+	micropython = shutil.which(args.micropython) or os.path.abspath(args.micropython)
+
+	root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+	with tempfile.TemporaryDirectory() as tmp:
+		variants = {}
+		for variant in ('py', 'mpy'):
+			directory = os.path.join(tmp, variant)
+			shutil.copytree(os.path.join(root, 'src'), os.path.join(directory, 'src'), ignore=shutil.ignore_patterns('*.mpy', '__pycache__'))
+			shutil.copy(__file__, directory)
+			if variant == 'mpy':
+				for path in mpy.sources(os.path.join(directory, 'src')):
+					# Portable bytecode, the unix port rejects armv6m files
+					mpy.build(path, args.mpyCross, arch=None)
+					os.remove(path)
+			variants[variant] = run(micropython, directory, args.runs, args.heap)
+
+	print('%-20s %10s %10s %10s %10s %10s %10s' % ('module', 'py us', 'mpy us', 'py peak', 'mpy peak', 'py kept', 'mpy kept'))
+	totals = [0] * 6
+	for name in MODULES:
+		if name not in variants['py'] or name not in variants['mpy']:
+			continue
+		(py, mpy_) = (variants['py'][name], variants['mpy'][name])
+		row = (py[0], mpy_[0], py[1], mpy_[1], py[2], mpy_[2])
+		totals = [t + v for (t, v) in zip(totals, row)]
+		print('%-20s %10d %10d %10d %10d %10d %10d' % ((name,) + row))
+	print('%-20s %10d %10d %10d %10d %10d %10d' % (('total',) + tuple(totals)))
+
+if __name__ == '__main__':
+	if sys.implementation.name == 'micropython':
+		measure()
+	else:
+		main()
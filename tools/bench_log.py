@@ -0,0 +1,69 @@
+# Compares writing every log line to flash with logger.Ring batches. Runs on
+# a station (mpremote run tools/bench_log.py after copying src), on the
+# MicroPython unix port or with CPython, from the repository root:
+#
+#   micropython tools/bench_log.py
+
+import os, sys, time
+sys.path.insert(0, '.')
+from src.lib import logger
+
+LINES = 500
+BATCH = 50 # about one measurement cycle of debug output
+PATH = 'bench.log'
+
+try:
+	ticks = time.ticks_us
+	diff = time.ticks_diff
+except AttributeError:
+	ticks = lambda: int(time.perf_counter() * 1000000)
+	diff = lambda a, b: a - b
+
+def lines():
+	for i in range(LINES):
+		yield ('weatherstation:read:bmp280', 'Temperature: %s C' % (20 + i % 10 / 10))
+
+def clean():
+	for name in (PATH, PATH + '.1', PATH + '.2'):
+		try:
+			os.remove(name)
+		except OSError:
+			pass
+
+def size():
+	total = 0
+	for name in (PATH, PATH + '.1', PATH + '.2'):
+		try:
+			total += os.stat(name)[6]
+		except OSError:
+			pass
+	return total
+
+def perLine():
+	# Opening, appending and closing for every line, what a plain file log does
+	for (name, message) in lines():
+		with open(PATH, 'a') as file:
+			file.write('[2024-01-01T00:00:00Z][%s] %s\n' % (name, message))
+
+def flushed():
+	# One open file, flushed after every line
+	with open(PATH, 'a') as file:
+		for (name, message) in lines():
+			file.write('[2024-01-01T00:00:00Z][%s] %s\n' % (name, message))
+			file.flush()
+
+def ring():
+	buffer = logger.Ring(size=4096, path=PATH, fileSize=1 << 20)
+	for (i, (name, message)) in enumerate(lines()):
+		buffer.write(757382400 + i, name, message)
+		if i % BATCH == BATCH - 1:
+			buffer.flush()
+	buffer.flush()
+
+for (label, run) in (('per line', perLine), ('flush per line', flushed), ('ring, batch of %d' % BATCH, ring)):
+	clean()
+	start = ticks()
+	run()
+	took = diff(ticks(), start)
+	print('%-20s %8d us total %6d us/line %7d bytes' % (label, took, took // LINES, size()))
+clean()
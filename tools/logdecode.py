@@ -0,0 +1,55 @@
+# Prints the log files a station wrote with logger.Ring, run on a computer
+# after copying them off the station (e.g. mpremote cp :log :log.1 .):
+#
+#   python tools/logdecode.py log.2 log.1 log
+
+import argparse, datetime, os, struct, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.lib import logger
+
+RECORD = struct.Struct(logger._RECORD)
+BATCH = struct.Struct(logger._BATCH)
+
+def batches(data):
+	# Yields (epoch year, dropped records, names by id, records) per batch
+	pos = 0
+	while pos < len(data):
+		(magic, epoch, dropped, count, size) = BATCH.unpack_from(data, pos)
+		if magic != logger.MAGIC:
+			raise ValueError('No batch at byte %d' % pos)
+		pos += BATCH.size
+		names = {}
+		for _ in range(count):
+			(id, length) = data[pos], data[pos + 1]
+			names[id] = data[pos + 2:pos + 2 + length].decode(errors='replace')
+			pos += 2 + length
+		yield (epoch, dropped, names, data[pos:pos + size])
+		pos += size
+
+def records(data):
+	pos = 0
+	while pos < len(data):
+		(time, id, length) = RECORD.unpack_from(data, pos)
+		pos += RECORD.size
+		yield (time, id, data[pos:pos + length].decode(errors='replace'))
+		pos += length
+
+def main():
+	parser = argparse.ArgumentParser(description='Decode station log files')
+	parser.add_argument('files', nargs='+', help='oldest first')
+	args = parser.parse_args()
+
+	for path in args.files:
+		with open(path, 'rb') as file:
+			data = file.read()
+		for (epoch, dropped, names, chunk) in batches(data):
+			if dropped:
+				print('... %d records lost, the ring buffer was full' % dropped)
+			start = datetime.datetime(epoch, 1, 1, tzinfo=datetime.timezone.utc)
+			for (time, id, message) in records(chunk):
+				when = (start + datetime.timedelta(seconds=time)).strftime('%Y-%m-%dT%H:%M:%SZ')
+				print('[%s][%s] %s' % (when, names.get(id, '?'), message))
+
+if __name__ == '__main__':
+	sys.exit(main())
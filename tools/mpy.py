@@ -0,0 +1,55 @@
+# Compiles the app to MicroPython bytecode for a release, run on a computer:
+#
+#   pip install mpy-cross
+#   python tools/mpy.py            # writes x.mpy next to every x.py in src
+#   python tools/mpy.py --clean    # removes them again
+#
+# The updater skips x.py when x.mpy is part of the release, so the .mpy files
+# must always be rebuilt together with the sources (e.g. on a release branch
+# the stations follow through githubRemoteBranch). mpy-cross has to emit the
+# .mpy version of the firmware on the stations, see `mpy-cross --version`.
+
+import argparse, os, subprocess, sys
+
+ARCH = 'armv6m' # RP2040 of the Pico W
+
+def sources(root):
+	for (directory, dirs, files) in os.walk(root):
+		dirs.sort()
+		for name in sorted(files):
+			if name.endswith('.py'):
+				yield os.path.join(directory, name)
+
+def build(path, mpyCross='mpy-cross', arch=ARCH, output=None):
+	command = [mpyCross]
+	if arch:
+		command.append('-march=' + arch)
+	if output:
+		command += ['-o', output]
+	# -s keeps tracebacks readable on the station: src/lib/update.py instead of update.py
+	subprocess.run(command + ['-s', path.replace(os.sep, '/'), path], check=True)
+	return output or path[:-3] + '.mpy'
+
+def main():
+	parser = argparse.ArgumentParser(description='Compile the app to .mpy bytecode')
+	parser.add_argument('root', nargs='?', default='src')
+	parser.add_argument('--arch', default=ARCH, help='mpy-cross -march, empty for portable bytecode')
+	parser.add_argument('--mpy-cross', default='mpy-cross', dest='mpyCross')
+	parser.add_argument('--clean', action='store_true', help='remove compiled files instead')
+	args = parser.parse_args()
+
+	count = 0
+	for path in sources(args.root):
+		compiled = path[:-3] + '.mpy'
+		if args.clean:
+			if os.path.exists(compiled):
+				os.remove(compiled)
+				count += 1
+			continue
+		build(path, args.mpyCross, args.arch)
+		print('%s -> %s (%d -> %d bytes)' % (path, compiled, os.path.getsize(path), os.path.getsize(compiled)))
+		count += 1
+	print('%s %d files' % ('Removed' if args.clean else 'Compiled', count))
+
+if __name__ == '__main__':
+	sys.exit(main())
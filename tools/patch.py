@@ -0,0 +1,90 @@
+# Writes binary patches for every file in src that changed between releases,
+# run on a computer in the repository before committing a release:
+#
+#   python tools/patch.py <sha of the previous release> [<sha of the new release>]
+#
+# Patches are named patches/<old blob>-<new blob>.patch, so they stay valid in
+# every later commit. Stations with the old file installed download the patch
+# instead of the whole file (delta otaMode), see src/lib/patch.py for the
+# format. Every patch is checked with the station's patcher before it is kept.
+
+import argparse, difflib, hashlib, io, os, subprocess, sys, zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.lib import patch
+
+WBITS = 10 # 1 KiB zlib window, the station has to hold it in RAM
+
+def git(*args):
+	return subprocess.run(('git',) + args, capture_output=True, check=True).stdout
+
+def varint(n):
+	out = bytearray()
+	while n >= 0x80:
+		out.append(n & 0x7f | 0x80)
+		n >>= 7
+	out.append(n)
+	return out
+
+def diff(old, new):
+	out = bytearray(patch.MAGIC)
+	out.append(patch.VERSION)
+	out += varint(len(old)) + varint(len(new))
+	matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+	for (tag, i1, i2, j1, j2) in matcher.get_opcodes():
+		if tag == 'equal':
+			out.append(patch.COPY)
+			out += varint(i1) + varint(i2 - i1)
+		elif tag == 'replace' and i2 - i1 == j2 - j1:
+			# Same length, like a changed constant or shifted offsets in bytecode:
+			# the byte differences are mostly zero and compress well
+			out.append(patch.DIFF)
+			out += varint(i1) + varint(i2 - i1)
+			out += bytes((new[j1 + k] - old[i1 + k]) & 0xff for k in range(i2 - i1))
+		elif tag in ('replace', 'insert'):
+			out.append(patch.INSERT)
+			out += varint(j2 - j1) + new[j1:j2]
+	out.append(patch.END)
+	compressor = zlib.compressobj(9, zlib.DEFLATED, WBITS)
+	return compressor.compress(bytes(out)) + compressor.flush()
+
+def blob(content):
+	return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+def verify(old, new, data):
+	out = io.BytesIO()
+	hash = hashlib.sha1(b'blob %d\0' % len(new))
+	patch.apply(io.BytesIO(old), io.BytesIO(zlib.decompress(data, WBITS)), out, bytearray(512), hash)
+	return out.getvalue() == new and hash.hexdigest() == blob(new)
+
+def main():
+	parser = argparse.ArgumentParser(description='Write patches between two releases')
+	parser.add_argument('old', help='commit the stations run now')
+	parser.add_argument('new', nargs='?', default='HEAD')
+	parser.add_argument('--base', default='src')
+	parser.add_argument('--out', default='patches')
+	parser.add_argument('--min-ratio', type=float, default=2, dest='minRatio', help='keep patches at least this many times smaller than the file')
+	args = parser.parse_args()
+
+	os.makedirs(args.out, exist_ok=True)
+	for line in git('diff-tree', '-r', '--no-renames', args.old, args.new, '--', args.base).decode().splitlines():
+		(meta, path) = line.split('\t', 1)
+		(_, _, oldBlob, newBlob, status) = meta.split(' ')
+		if status != 'M':
+			continue
+		old = git('cat-file', 'blob', oldBlob)
+		new = git('cat-file', 'blob', newBlob)
+		data = diff(old, new)
+		if not verify(old, new, data):
+			raise Exception('Patch for %s does not reproduce the file' % path)
+		ratio = len(new) / max(len(data), 1)
+		if ratio < args.minRatio:
+			print('%s: patch is only %.1fx smaller, skipped' % (path, ratio))
+			continue
+		name = os.path.join(args.out, '%s-%s.patch' % (oldBlob, newBlob))
+		with open(name, 'wb') as file:
+			file.write(data)
+		print('%s: %d -> %d bytes (%.1fx) %s' % (path, len(new), len(data), ratio, name))
+
+if __name__ == '__main__':
+	sys.exit(main())